@@ -0,0 +1,103 @@
+"""
+Propagation of writes made outside the bot into its caches, against a real mongo
+
+    docker run -d --name mongo-rs -p 27017:27017 mongo:latest --replSet rs0
+    docker exec mongo-rs mongosh --quiet --eval "rs.initiate()"
+    python -m benchmarks.cache_watcher --uri "mongodb://localhost:27017/?directConnection=true"
+
+A second client changes roles, barrier access and barriers directly, like
+mongo-express does, and the time until `CacheWatcher` brings the caches of
+`Database` up to date is measured. Against a standalone mongo the watcher
+falls back to polling, which doesn't see such writes, and the check fails.
+Everything is written to a separate database, dropped at the end
+"""
+from typing import Callable, List
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import bot.handlers.manage_data as md
+from bot.database import Database
+from bot.watcher import CacheWatcher
+
+
+async def wait_for(condition: Callable[[], bool], timeout: float) -> float:
+    started_at = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started_at > timeout:
+            raise TimeoutError("Cache was not updated in time")
+        await asyncio.sleep(0.001)
+    return time.perf_counter() - started_at
+
+
+async def run(args: argparse.Namespace) -> None:
+    db = Database(uri=args.uri, name=args.db_name)
+    writer = AsyncIOMotorClient(args.uri)[args.db_name]
+    await db.client.drop_database(args.db_name)
+    watcher = CacheWatcher(db, poll_interval=1.0, poll=True)
+    try:
+        barrier_id = ObjectId()
+        await writer["barrier"].insert_one({"_id": barrier_id, "phone_number": "+70000000000", "name": "barrier"})
+        user_ids = list(range(1, args.users + 1))
+        await writer["user"].insert_many([{"_id": x, "role": md.Role.USER.value, "barriers": []} for x in user_ids])
+        for user_id in user_ids:
+            await db.get_user(user_id)
+        await db.get_barrier(barrier_id)
+
+        watcher.start()
+        await asyncio.sleep(1.0)
+        print(f"change streams: {'yes' if watcher.is_watching else 'no, polling'}")
+
+        latencies: List[float] = []
+        for user_id in user_ids:
+            await writer["user"].update_one(
+                {"_id": user_id},
+                {"$set": {"role": md.Role.ADMIN.value}, "$push": {"barriers": barrier_id}},
+            )
+            latencies.append(await wait_for(
+                lambda: (db.user_cache.get(user_id) or {}).get("barriers") == [barrier_id],
+                timeout=args.timeout,
+            ))
+        # changed users stay cached, patched from the change event
+        assert all(db.user_cache.get(x) is not None for x in user_ids)
+        assert await db.get_user_role(user_ids[0]) == md.Role.ADMIN
+
+        barriers_version = db.barriers_version
+        await writer["barrier"].update_one({"_id": barrier_id}, {"$set": {"name": "renamed"}})
+        latencies.append(await wait_for(lambda: db.barrier_cache.get(barrier_id) is None, timeout=args.timeout))
+        assert db.barriers_version > barriers_version
+        assert (await db.get_barrier(barrier_id))["name"] == "renamed"
+
+        await writer["user"].delete_one({"_id": user_ids[0]})
+        latencies.append(await wait_for(lambda: db.user_cache.get(user_ids[0]) is None, timeout=args.timeout))
+        assert await db.get_user(user_ids[0]) is None
+
+        latencies.sort()
+        print(
+            f"changes: {len(latencies)}, propagation p50: {statistics.median(latencies) * 1e3:.1f} ms, "
+            f"p95: {latencies[int(len(latencies) * 0.95) - 1] * 1e3:.1f} ms, max: {latencies[-1] * 1e3:.1f} ms"
+        )
+    finally:
+        await watcher.stop()
+        await db.client.drop_database(args.db_name)
+        db.client.close()
+        writer.client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="mongodb://localhost:27017/?directConnection=true")
+    parser.add_argument("--db-name", default="bot_cache_watcher_benchmark")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for every change")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Encode/decode microbenchmarks of callback data
+
+    python -m benchmarks.callback_data
+"""
+from dataclasses import asdict
+import timeit
+
+from bson.objectid import ObjectId
+
+import bot.handlers.manage_data as md
+
+
+def dump_legacy(data: md.CallbackData) -> str:
+    # reflective text format used before the compact codec
+    values = asdict(data)
+    values.pop("prefix")
+    parts = [data.legacy_prefix, *values.values()]
+    return md.LEGACY_SEPARATOR.join(str(x) for x in parts)
+
+
+def main(number: int = 100000) -> None:
+    samples = [
+        md.BarrierData(barrier_id=ObjectId()),
+        md.BarrierAccessData(barrier_id=ObjectId(), user_id=6123456789),
+        md.ChooseRoleData(role=md.Role.USER, user_id=6123456789),
+    ]
+    print(f"{'class':<20} {'format':<8} {'bytes':>5} {'dump, us':>9} {'load, us':>9}")
+    for data in samples:
+        cls = type(data)
+        for name, dump in (("compact", cls.dump), ("legacy", dump_legacy)):
+            dumped = dump(data)
+            assert cls.load(dumped) == data
+            dump_time = timeit.timeit(lambda: dump(data), number=number) / number
+            load_time = timeit.timeit(lambda: cls.load(dumped), number=number) / number
+            print(
+                f"{cls.__name__:<20} {name:<8} {len(dumped.encode()):>5} "
+                f"{dump_time * 1e6:>9.2f} {load_time * 1e6:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
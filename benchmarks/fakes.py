@@ -0,0 +1,417 @@
+"""In-memory stand-ins for mongo collections, Telegram Bot API and Zadarma API"""
+from typing import Optional, Any, Dict, List, Sequence, Tuple
+from collections import Counter
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import copy
+import itertools
+import threading
+import time
+import json
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from telegram.ext import ExtBot
+
+
+# operations of the update being processed, set by the benchmark driver
+update_operations: "ContextVar[Optional[Counter]]" = ContextVar("update_operations", default=None)
+
+
+def count_operation(counter: Counter, key: str) -> None:
+    counter[key] += 1
+    operations = update_operations.get()
+    if operations is not None:
+        operations[key] += 1
+
+
+def _values(doc: Dict[str, Any], key: str) -> List[Any]:
+    # array fields match if any of their elements matches, like in mongo
+    value = doc.get(key)
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _match_condition(doc: Dict[str, Any], key: str, condition: Any) -> bool:
+    values = _values(doc, key)
+    if not isinstance(condition, dict):
+        return condition in values
+    for op, arg in condition.items():
+        if op == "$in":
+            ok = any(x in values for x in arg)
+        elif op == "$nin":
+            ok = not any(x in values for x in arg)
+        elif op == "$ne":
+            ok = arg not in values
+        elif op == "$exists":
+            ok = (key in doc) == arg
+        elif op in ("$lt", "$lte", "$gt", "$gte"):
+            compare = {
+                "$lt": lambda x: x < arg,
+                "$lte": lambda x: x <= arg,
+                "$gt": lambda x: x > arg,
+                "$gte": lambda x: x >= arg,
+            }[op]
+            ok = any(x is not None and compare(x) for x in values)
+        else:
+            raise NotImplementedError(f"Operator {op} is not supported")
+        if not ok:
+            return False
+    return True
+
+
+def match(doc: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(match(doc, x) for x in condition):
+                return False
+        elif not _match_condition(doc, key, condition):
+            return False
+    return True
+
+
+def project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not projection:
+        return copy.deepcopy(doc)
+    result = {key: doc[key] for key in projection if projection[key] and key in doc}
+    if projection.get("_id", 1):
+        result["_id"] = doc["_id"]
+    return copy.deepcopy(result)
+
+
+def apply_update(doc: Dict[str, Any], update: Dict[str, Any], is_insert: bool = False) -> None:
+    for op, changes in update.items():
+        for key, value in changes.items():
+            if op == "$set":
+                doc[key] = copy.deepcopy(value)
+            elif op == "$setOnInsert":
+                if is_insert:
+                    doc[key] = copy.deepcopy(value)
+            elif op == "$inc":
+                # dotted keys increment fields of embedded documents
+                *path, name = key.split(".")
+                target = doc
+                for part in path:
+                    target = target.setdefault(part, {})
+                target[name] = target.get(name, 0) + value
+            elif op == "$addToSet":
+                values = doc.setdefault(key, [])
+                to_add = value["$each"] if isinstance(value, dict) else [value]
+                values.extend(x for x in to_add if x not in values)
+            elif op == "$pull":
+                to_remove = value["$in"] if isinstance(value, dict) else [value]
+                doc[key] = [x for x in doc.get(key, []) if x not in to_remove]
+            elif op == "$unset":
+                doc.pop(key, None)
+            else:
+                raise NotImplementedError(f"Operator {op} is not supported")
+
+
+class _Result:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+async def wait_round_trip(latency: float, blocking: bool) -> None:
+    if blocking:
+        # like a synchronous driver called from a coroutine, the whole loop waits
+        time.sleep(latency)
+    else:
+        await asyncio.sleep(latency)
+
+
+class FakeCursor:
+    def __init__(self, docs: List[Dict[str, Any]], latency: float = 0.0, blocking: bool = False):
+        self.docs = docs
+        self.latency = latency
+        self.blocking = blocking
+
+    def sort(self, key, direction: int = 1):
+        if isinstance(key, list):
+            for k, d in reversed(key):
+                self.sort(k, d)
+            return self
+        self.docs.sort(key=lambda x: x.get(key), reverse=direction < 0)
+        return self
+
+    def skip(self, n: int):
+        self.docs = self.docs[n:]
+        return self
+
+    def limit(self, n: int):
+        if n:
+            self.docs = self.docs[:n]
+        return self
+
+    def batch_size(self, n: int):
+        return self
+
+    async def to_list(self, length: Optional[int] = None):
+        await wait_round_trip(self.latency, self.blocking)
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await wait_round_trip(self.latency, self.blocking)
+        for doc in self.docs:
+            yield doc
+
+
+class FakeCollection:
+    """
+    Subset of `AsyncIOMotorCollection` used by `bot.database`, counting round trips.
+    `blocking` collections block the event loop for every round trip, like pymongo would
+    """
+
+    def __init__(self, name: str, counter: Counter, latency: float = 0.0, blocking: bool = False):
+        self.name = name
+        self.counter = counter
+        self.latency = latency
+        self.blocking = blocking
+        self.docs: Dict[Any, Dict[str, Any]] = {}
+
+    async def _round_trip(self, op: str) -> None:
+        count_operation(self.counter, f"mongo.{self.name}.{op}")
+        await wait_round_trip(self.latency, self.blocking)
+
+    def _find(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        _id = query.get("_id")
+        if _id is not None and not isinstance(_id, dict):
+            doc = self.docs.get(_id)
+            return [doc] if doc is not None and match(doc, query) else []
+        return [doc for doc in self.docs.values() if match(doc, query)]
+
+    def _upsert(self, query: Dict[str, Any], update: Dict[str, Any]) -> Dict[str, Any]:
+        doc = {key: value for key, value in query.items() if not isinstance(value, dict) and not key.startswith("$")}
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"Duplicate key {doc['_id']} in {self.name}")
+        apply_update(doc, update, is_insert=True)
+        self.docs[doc["_id"]] = doc
+        return doc
+
+    def _update_one(self, query, update, upsert=False):
+        docs = self._find(query)
+        if docs:
+            apply_update(docs[0], update)
+            return _Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            return _Result(matched_count=0, modified_count=0, upserted_id=self._upsert(query, update)["_id"])
+        return _Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def find_one(self, query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None):
+        await self._round_trip("find_one")
+        docs = self._find(query)
+        return project(docs[0], projection) if docs else None
+
+    def find(self, query: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None):
+        count_operation(self.counter, f"mongo.{self.name}.find")
+        return FakeCursor([project(x, projection) for x in self._find(query or {})], latency=self.latency, blocking=self.blocking)
+
+    async def count_documents(self, query: Dict[str, Any]) -> int:
+        await self._round_trip("count_documents")
+        return len(self._find(query))
+
+    async def insert_one(self, doc: Dict[str, Any]):
+        await self._round_trip("insert_one")
+        doc.setdefault("_id", ObjectId())
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+        return _Result(inserted_id=doc["_id"])
+
+    async def insert_many(self, docs: List[Dict[str, Any]], ordered: bool = True):
+        await self._round_trip("insert_many")
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+            self.docs[doc["_id"]] = copy.deepcopy(doc)
+        return _Result(inserted_ids=[x["_id"] for x in docs])
+
+    async def update_one(self, query, update, upsert=False):
+        await self._round_trip("update_one")
+        return self._update_one(query, update, upsert=upsert)
+
+    async def update_many(self, query, update, upsert=False):
+        await self._round_trip("update_many")
+        docs = self._find(query)
+        for doc in docs:
+            apply_update(doc, update)
+        return _Result(matched_count=len(docs), modified_count=len(docs), upserted_id=None)
+
+    async def delete_one(self, query):
+        await self._round_trip("delete_one")
+        docs = self._find(query)
+        if docs:
+            del self.docs[docs[0]["_id"]]
+        return _Result(deleted_count=len(docs[:1]))
+
+    async def delete_many(self, query):
+        await self._round_trip("delete_many")
+        docs = self._find(query)
+        for doc in docs:
+            del self.docs[doc["_id"]]
+        return _Result(deleted_count=len(docs))
+
+    async def find_one_and_delete(self, query, projection=None):
+        await self._round_trip("find_one_and_delete")
+        docs = self._find(query)
+        if not docs:
+            return None
+        del self.docs[docs[0]["_id"]]
+        return project(docs[0], projection)
+
+    async def find_one_and_update(
+        self,
+        query,
+        update,
+        projection=None,
+        upsert=False,
+        return_document=ReturnDocument.BEFORE,
+    ):
+        await self._round_trip("find_one_and_update")
+        docs = self._find(query)
+        if docs:
+            before = project(docs[0], projection)
+            apply_update(docs[0], update)
+            return project(docs[0], projection) if return_document else before
+        if upsert:
+            doc = self._upsert(query, update)
+            return project(doc, projection) if return_document else None
+        return None
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        await self._round_trip("bulk_write")
+        matched_count = upserted_count = inserted_count = 0
+        for request in requests:
+            name = type(request).__name__
+            if name in ("UpdateOne", "UpdateMany"):
+                result = self._update_one(request._filter, request._doc, upsert=request._upsert)
+                matched_count += result.matched_count
+                upserted_count += result.upserted_id is not None
+            elif name == "InsertOne":
+                doc = request._doc
+                doc.setdefault("_id", ObjectId())
+                self.docs[doc["_id"]] = copy.deepcopy(doc)
+                inserted_count += 1
+            else:
+                raise NotImplementedError(f"Bulk operation {name} is not supported")
+        return _Result(
+            matched_count=matched_count,
+            modified_count=matched_count,
+            upserted_count=upserted_count,
+            inserted_count=inserted_count,
+        )
+
+    async def create_index(self, keys, **kwargs):
+        await self._round_trip("create_index")
+
+
+class FakeBot(ExtBot):
+    """
+    Bot answering every Bot API request locally and recording it.
+    getUpdates long polls updates given to `push_update`
+    """
+
+    def __init__(self, counter: Counter, latency: float = 0.0):
+        super().__init__(token="123456:fake")
+        with self._unfrozen():
+            self.counter = counter
+            self.latency = latency
+            self.calls: List[Tuple[str, Dict[str, Any]]] = []
+            self._message_ids = itertools.count(1000)
+            self._updates: Optional["asyncio.Queue[Dict[str, Any]]"] = None
+
+    def _get_update_queue(self) -> "asyncio.Queue[Dict[str, Any]]":
+        # created in the running loop
+        if self._updates is None:
+            with self._unfrozen():
+                self._updates = asyncio.Queue()
+        return self._updates
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        self._get_update_queue().put_nowait(update)
+
+    async def _get_updates(self, timeout: float) -> List[Dict[str, Any]]:
+        # `latency` is a round trip, the request and the response take half of it each
+        queue = self._get_update_queue()
+        await asyncio.sleep(self.latency / 2)
+        try:
+            updates = [await asyncio.wait_for(queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            updates = []
+        while not queue.empty():
+            updates.append(queue.get_nowait())
+        await asyncio.sleep(self.latency / 2)
+        return updates
+
+    async def _do_post(self, endpoint: str, data: Dict[str, Any], **kwargs) -> Any:
+        self.calls.append((endpoint, data))
+        count_operation(self.counter, f"telegram.{endpoint}")
+        if endpoint == "getUpdates":
+            return await self._get_updates(float(data.get("timeout") or 0))
+        await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Bot", "username": "bot_username"}
+        if endpoint in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": data.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": data["chat_id"], "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+
+class FakeZadarmaServer:
+    """
+    Local HTTP server answering Zadarma API requests after `latency` seconds,
+    with `statuses` for the first requests and `status` for the rest
+    """
+
+    def __init__(self, latency: float = 0.0, status: int = 200, statuses: Sequence[int] = ()):
+        self.latency = latency
+        self.status = status
+        self.statuses = list(statuses)
+        self.requests: List[str] = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self):
+                server.requests.append(self.path)
+                status = server.statuses.pop(0) if server.statuses else server.status
+                time.sleep(server.latency)
+                body = json.dumps({"status": "success" if status == 200 else "error"}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                try:
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up waiting, e.g. on a read timeout
+                    pass
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def __enter__(self) -> "FakeZadarmaServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
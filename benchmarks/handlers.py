@@ -0,0 +1,276 @@
+"""
+Offline load and latency benchmark of the bot handlers
+
+Drives synthetic Telegram updates through the real `bot.handlers` with mongo,
+Bot API and Zadarma API replaced by the local fakes from `benchmarks.fakes`:
+
+    python -m benchmarks.handlers --updates 5000 --concurrency 50 --db-latency 0.002
+
+With --sync-db the same updates are driven once more with mongo round trips
+blocking the event loop, as a synchronous driver would, to compare latencies
+"""
+from typing import Any, Dict, List, Tuple
+from collections import Counter, defaultdict
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import statistics
+import time
+
+from bson.objectid import ObjectId
+from telegram import Update
+
+import bot.handlers.manage_data as md
+from bot.app import build_application
+from bot.services import services
+from bot.zadarma.api import AsyncZadarmaAPI
+from bot.zadarma.governor import TokenBucket
+from benchmarks.fakes import (
+    FakeBot,
+    FakeCollection,
+    FakeZadarmaServer,
+    update_operations,
+)
+
+
+ADMIN_ID = 1
+SCENARIOS = {
+    "start": 0.1,
+    "open": 0.3,
+    "tap": 0.4,
+    "contact": 0.05,
+    "toggle": 0.15,
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+class UpdateFactory:
+    def __init__(self, bot: FakeBot, barrier_ids: List[ObjectId], user_ids: List[int]):
+        self.bot = bot
+        self.barrier_ids = barrier_ids
+        self.user_ids = user_ids
+        self.update_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        username = "admin" if user_id == ADMIN_ID else f"user{user_id}"
+        return {"id": user_id, "is_bot": False, "first_name": username, "username": username}
+
+    def _message(self, user_id: int, **kwargs) -> Dict[str, Any]:
+        return {
+            "message_id": next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **kwargs,
+        }
+
+    def _update(self, **kwargs) -> Update:
+        return Update.de_json({"update_id": next(self.update_ids), **kwargs}, self.bot)
+
+    def command(self, user_id: int, command: str) -> Update:
+        entities = [{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}]
+        return self._update(message=self._message(user_id, text=command, entities=entities))
+
+    def callback(self, user_id: int, data: str) -> Update:
+        message = self._message(user_id, text="Выбери шлагбаум:")
+        message["from"] = {"id": 123456, "is_bot": True, "first_name": "Bot"}
+        return self._update(callback_query={
+            "id": str(next(self.update_ids)),
+            "from": self._user(user_id),
+            "chat_instance": "1",
+            "data": data,
+            "message": message,
+        })
+
+    def make(self, scenario: str, rng: random.Random) -> Update:
+        user_id = rng.choice(self.user_ids)
+        if scenario == "start":
+            return self.command(user_id, "/start")
+        if scenario == "open":
+            return self.command(user_id, "/open")
+        if scenario == "tap":
+            barrier_ids = services.db.user_collection.docs[user_id].get("barriers") or self.barrier_ids
+            return self.callback(user_id, md.BarrierData(rng.choice(barrier_ids)).dump())
+        if scenario == "contact":
+            contact = {"phone_number": "+70000000000", "first_name": f"user{user_id}", "user_id": user_id}
+            return self._update(message=self._message(ADMIN_ID, contact=contact))
+        if scenario == "toggle":
+            data = md.BarrierAccessData(barrier_id=rng.choice(self.barrier_ids), user_id=user_id)
+            return self.callback(ADMIN_ID, data.dump())
+        raise ValueError(f"Unknown scenario {scenario}")
+
+
+def seed(n_users: int, n_barriers: int, barriers_per_user: int, rng: random.Random) -> Tuple[List[ObjectId], List[int]]:
+    barrier_ids = []
+    for i in range(n_barriers):
+        barrier_id = ObjectId()
+        services.db.barrier_collection.docs[barrier_id] = {
+            "_id": barrier_id,
+            "phone_number": f"+7900{i:07d}",
+            "name": f"barrier_{i}",
+        }
+        barrier_ids.append(barrier_id)
+    services.db.user_collection.docs[ADMIN_ID] = {
+        "_id": ADMIN_ID,
+        "role": md.Role.ADMIN.value,
+        "username": "admin",
+        "first_name": "admin",
+        "barriers": list(barrier_ids),
+    }
+    user_ids = list(range(ADMIN_ID + 1, ADMIN_ID + 1 + n_users))
+    for user_id in user_ids:
+        services.db.user_collection.docs[user_id] = {
+            "_id": user_id,
+            "role": md.Role.USER.value,
+            "username": f"user{user_id}",
+            "first_name": f"user{user_id}",
+            "barriers": rng.sample(barrier_ids, min(barriers_per_user, n_barriers)),
+        }
+    return barrier_ids, user_ids
+
+
+def reset_services() -> None:
+    # the next run starts with new clients and empty caches
+    for name in ("keyboard_cache", "z_api", "z_governor", "open_dispatcher"):
+        vars(services).pop(name, None)
+    services.db.drop_caches()
+
+
+async def run(args: argparse.Namespace, sync_db: bool = False) -> List[float]:
+    """Returns latencies of all updates"""
+    rng = random.Random(args.seed)
+    operations = Counter()
+    for name in ("user", "barrier", "event", "usage"):
+        collection = FakeCollection(name, operations, latency=args.db_latency, blocking=sync_db)
+        setattr(services.db, f"{name}_collection", collection)
+    if args.no_cache:
+        for cache in (services.db.user_cache, services.db.barrier_cache, services.keyboard_cache):
+            cache.maxsize = 0
+    barrier_ids, user_ids = seed(args.users, args.barriers, args.barriers_per_user, rng)
+
+    fake_bot = FakeBot(operations, latency=args.telegram_latency)
+    application = build_application(bot=fake_bot)
+    errors = []
+
+    async def count_error(update: object, context: Any) -> None:
+        errors.append(context.error)
+
+    application.add_error_handler(count_error)
+
+    with FakeZadarmaServer(latency=args.zadarma_latency) as zadarma:
+        services.z_api = AsyncZadarmaAPI(key="key", secret="secret", url_api=zadarma.url)
+        services.z_governor.bucket = TokenBucket(rate=1e9, capacity=1e9)
+        services.open_dispatcher.window = args.coalesce_window
+        await application.initialize()
+        factory = UpdateFactory(fake_bot, barrier_ids, user_ids)
+        scenarios = rng.choices(list(SCENARIOS), weights=list(SCENARIOS.values()), k=args.updates)
+        latencies: Dict[str, List[float]] = defaultdict(list)
+        update_ops: Dict[str, Counter] = defaultdict(Counter)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        operations.clear()
+
+        async def process(scenario: str) -> None:
+            async with semaphore:
+                update = factory.make(scenario, rng)
+                ops = Counter()
+                update_operations.set(ops)
+                started_at = time.perf_counter()
+                await application.process_update(update)
+                latencies[scenario].append(time.perf_counter() - started_at)
+                update_ops[scenario].update(ops)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*[process(x) for x in scenarios])
+        wall_time = time.perf_counter() - started_at
+        await services.db.flush_profile_updates()
+        await services.db.flush_events()
+        await services.db.flush_usage()
+        await services.z_api.close()
+        await application.shutdown()
+        n_zadarma_requests = len(zadarma.requests)
+
+    report(args, latencies, update_ops, wall_time, n_zadarma_requests, errors)
+    return sum(latencies.values(), [])
+
+
+async def compare(args: argparse.Namespace) -> None:
+    if not args.sync_db:
+        await run(args)
+        return
+    print("async db:")
+    async_latencies = await run(args)
+    reset_services()
+    print("\nsync db, blocking the event loop:")
+    sync_latencies = await run(args, sync_db=True)
+    print(
+        f"\np99: async db {percentile(async_latencies, 99) * 1e3:.2f} ms, "
+        f"sync db {percentile(sync_latencies, 99) * 1e3:.2f} ms"
+    )
+
+
+def report(
+    args: argparse.Namespace,
+    latencies: Dict[str, List[float]],
+    update_ops: Dict[str, Counter],
+    wall_time: float,
+    n_zadarma_requests: int,
+    errors: List[Exception],
+) -> None:
+    def count(ops: Counter, prefix: str) -> int:
+        return sum(v for k, v in ops.items() if k.startswith(prefix))
+
+    n_updates = sum(len(x) for x in latencies.values())
+    print(
+        f"updates: {n_updates}, concurrency: {args.concurrency}, wall time: {wall_time:.2f}s, "
+        f"throughput: {n_updates / wall_time:.1f} updates/s, errors: {len(errors)}, "
+        f"zadarma calls: {n_zadarma_requests}"
+    )
+    header = f"{'scenario':<10} {'count':>6} {'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8} {'db ops':>7} {'tg calls':>9}"
+    print(header)
+    print("-" * len(header))
+    rows = [(x, latencies[x], update_ops[x]) for x in SCENARIOS if latencies[x]]
+    rows.append(("total", sum(latencies.values(), []), sum(update_ops.values(), Counter())))
+    for scenario, values, ops in rows:
+        print(
+            f"{scenario:<10} {len(values):>6} "
+            f"{percentile(values, 50) * 1e3:>8.2f} {percentile(values, 95) * 1e3:>8.2f} "
+            f"{percentile(values, 99) * 1e3:>8.2f} "
+            f"{count(ops, 'mongo.') / len(values):>7.2f} {count(ops, 'telegram.') / len(values):>9.2f}"
+        )
+    if args.verbose:
+        print()
+        for key, value in sorted(sum(update_ops.values(), Counter()).items()):
+            print(f"{key:<40} {value / n_updates:>7.3f} per update")
+    for error in errors[:5]:
+        print(f"error: {error!r}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--barriers", type=int, default=20)
+    parser.add_argument("--barriers-per-user", type=int, default=3)
+    parser.add_argument("--db-latency", type=float, default=0.001, help="seconds per mongo round trip")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per Bot API request")
+    parser.add_argument("--zadarma-latency", type=float, default=0.05, help="seconds per Zadarma API request")
+    parser.add_argument("--coalesce-window", type=float, default=5.0)
+    parser.add_argument("--no-cache", action="store_true", help="disable in-process user, barrier and keyboard caches")
+    parser.add_argument("--sync-db", action="store_true", help="also run with mongo blocking the event loop")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="print every operation type")
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(compare(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
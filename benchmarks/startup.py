@@ -0,0 +1,85 @@
+"""
+Cold start time of the bot, every run in a fresh interpreter
+
+    python -m benchmarks.startup --runs 20
+    python -m benchmarks.startup --path /path/to/other/checkout
+
+Phases: `import bot.app`, reading config, `build_application()` and
+building the services used by the first update, stopping short of any
+network call. Older checkouts without some phase just skip it
+"""
+from typing import Dict, List
+from pathlib import Path
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+PHASES = ["import", "config", "application", "services", "total"]
+
+CHILD = """
+import json, time
+timings = {}
+started_at = time.perf_counter()
+import bot.app
+timings["import"] = time.perf_counter() - started_at
+
+t = time.perf_counter()
+from bot import config
+if hasattr(config, "load"):
+    config.load()
+    timings["config"] = time.perf_counter() - t
+
+t = time.perf_counter()
+bot.app.build_application()
+timings["application"] = time.perf_counter() - t
+
+try:
+    from bot.services import services
+except ImportError:
+    pass
+else:
+    t = time.perf_counter()
+    services.db
+    services.open_dispatcher
+    timings["services"] = time.perf_counter() - t
+
+timings["total"] = time.perf_counter() - started_at
+print(json.dumps(timings))
+"""
+
+
+def measure(path: Path) -> Dict[str, float]:
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        cwd=path,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--path", type=Path, default=Path(__file__).parent.parent, help="checkout to measure")
+    args = parser.parse_args()
+
+    runs: Dict[str, List[float]] = {x: [] for x in PHASES}
+    for _ in range(args.runs):
+        for phase, value in measure(args.path).items():
+            runs[phase].append(value)
+
+    header = f"{'phase':<12} {'median, ms':>11} {'min, ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for phase in PHASES:
+        if runs[phase]:
+            print(f"{phase:<12} {statistics.median(runs[phase]) * 1e3:>11.1f} {min(runs[phase]) * 1e3:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Benchmark of splitting long texts into Telegram messages, checking the
+single-pass splitter against the recursive one it replaced:
+
+    python -m benchmarks.text_split --size 4000000
+
+Chunks of plain text, without "<" or "&", must be identical to the old ones.
+For html every chunk must fit, have balanced tags and give the original
+text back once the tags added at the breaks are removed. Text with a stray
+"<" before long words must be split as fast as the rest, into its own pieces
+"""
+from typing import List, Tuple
+from html.parser import HTMLParser
+import argparse
+import html
+import json
+import random
+import time
+
+from telegram.constants import MessageLimit
+
+from bot.handlers.utils import split_text_at_good_places, split_text_into_chunks
+
+
+def split_text_legacy(
+    text: str,
+    message_size_limit: int,
+    separators: Tuple[str, ...] = ('\n\n', '\n', '. ', '! ', '? ', ', ', ' '),
+) -> List[str]:
+    # recursive splitter used before the single-pass one
+    if len(separators) == 0:
+        parts = list(split_text_into_chunks(text, message_size_limit - 1))
+    else:
+        separator = separators[0]
+        parts = text.split(separator)
+        parts = [x + separator for x in parts[:-1]] + [parts[-1]]
+
+    result = []
+    for part in parts:
+        if len(part) < message_size_limit:
+            result.append(part)
+        else:
+            result += split_text_legacy(part, message_size_limit, separators=separators[1:])
+    return result
+
+
+def combine_parts_legacy(parts: List[str], message_size_limit: int) -> List[str]:
+    result = [parts[0]]
+    for part in parts[1:]:
+        if len(result[-1] + part) < message_size_limit:
+            result[-1] = result[-1] + part
+        else:
+            result.append(part)
+    return result
+
+
+def make_plain_text(size: int, rng: random.Random) -> str:
+    alphabet = "abcdefghij"
+    separators = ["\n\n", "\n", ". ", "! ", "? ", ", ", " ", " ", " ", ""]
+    words = []
+    length = 0
+    while length < size:
+        # mostly short words, sometimes a long unbroken line or a run of newlines
+        n = rng.choice([1, 3, 5, 8, 13, 300, 5000]) if rng.random() < 0.01 else rng.randint(1, 12)
+        word = "".join(rng.choice(alphabet) for _ in range(min(n, 50))) * max(1, n // 50)
+        separator = "\n" * rng.randint(3, 9) if rng.random() < 0.01 else rng.choice(separators)
+        words.append(word + separator)
+        length += len(words[-1])
+    return "".join(words)
+
+
+def make_html_text(size: int, rng: random.Random) -> str:
+    blocks = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.3:
+            update = {"update_id": rng.randint(1, 10**9), "message": {"text": "<&>" * rng.randint(1, 200)}}
+            block = f"<b>🔄 Update:</b>\n<pre>update = {html.escape(json.dumps(update, indent=2))}</pre>\n\n"
+        elif kind < 0.6:
+            frames = "".join(
+                f'  File "/app/bot/handlers/x{i}.py", line {i}, in f\n    x = a &lt; b &amp;&amp; c\n'
+                for i in range(rng.randint(1, 400))
+            )
+            block = f"<b>🔴 Traceback:</b>\n<pre><code class=\"language-python\">{frames}</code></pre>\n\n"
+        elif kind < 0.8:
+            block = f'<a href="https://t.me/bot?start={rng.random()}">link</a>, <i>' + "word " * rng.randint(1, 50) + "</i>\n"
+        else:
+            block = "<pre>" + "&quot;" * rng.randint(1, 3000) + "x" * rng.randint(1, 9000) + "</pre>\n"
+        blocks.append(block)
+        length += len(block)
+    return "".join(blocks)
+
+
+def make_stray_text(size: int, rng: random.Random) -> str:
+    # text with "<" but without ">", like an unescaped comparison, often before a long word
+    words = []
+    length = 0
+    while length < size:
+        n = rng.choice([300, 2000, 5000]) if rng.random() < 0.1 else rng.randint(1, 12)
+        word = "".join(rng.choice("abcdefghij") for _ in range(min(n, 50))) * max(1, n // 50)
+        prefix = "<" if rng.random() < 0.3 else ""
+        words.append(prefix + word + rng.choice([" ", " ", "\n", ". "]))
+        length += len(words[-1])
+    return "".join(words)
+
+
+def check_stray_chunks(text: str, chunks: List[str], message_size_limit: int) -> None:
+    # without ">" there are no tags, chunks are just pieces of the text
+    assert all(len(x) < message_size_limit for x in chunks), "chunk too long"
+    assert "".join(chunks) == text, "text changed"
+
+
+class _TagBalanceChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        assert self.stack and self.stack[-1] == tag, f"unbalanced </{tag}>"
+        self.stack.pop()
+
+    def handle_entityref(self, name):
+        assert name in ("lt", "gt", "amp", "quot"), f"broken entity &{name}"
+
+
+def check_html_chunks(text: str, chunks: List[str], message_size_limit: int) -> None:
+    position = 0
+    for chunk in chunks:
+        assert len(chunk) < message_size_limit, "chunk too long"
+        checker = _TagBalanceChecker()
+        checker.feed(chunk)
+        checker.close()
+        assert not checker.stack, f"unclosed {checker.stack}"
+        # the chunk must be text[position:end] wrapped into tags open at both ends
+        opening = "".join(_open_tags(text, position))
+        assert chunk.startswith(opening), "tags not reopened"
+        body = chunk[len(opening):]
+        end = position
+        while end < len(text) and end - position < len(body) and body[end - position] == text[end]:
+            end += 1
+        while body[end - position:] != _closing(_open_tags(text, end)):
+            end -= 1
+            assert end >= position, "text changed"
+        position = end
+    assert position == len(text), "text lost"
+
+
+def _closing(tags: List[str]) -> str:
+    return "".join(f"</{x[1:-1].split()[0]}>" for x in reversed(tags))
+
+
+def _open_tags(text: str, position: int) -> List[str]:
+    # tags open at `position` of the original text, recomputed from scratch for checking only
+    stack = []
+    i = 0
+    while True:
+        i = text.find("<", i, position)
+        if i == -1:
+            return stack
+        j = text.index(">", i)
+        if j >= position:
+            return stack
+        tag = text[i:j + 1]
+        if tag.startswith("</"):
+            stack.pop()
+        else:
+            stack.append(tag)
+        i = j + 1
+
+
+def timed(fn, *args) -> Tuple[float, list]:
+    started_at = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started_at, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=4_000_000, help="characters in each generated text")
+    parser.add_argument("--checks", type=int, default=300, help="number of small random texts to check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    limit = MessageLimit.MAX_TEXT_LENGTH
+
+    for _ in range(args.checks):
+        size = rng.randint(0, 30000)
+        text = make_plain_text(size, rng)
+        for message_size_limit in (rng.randint(2, 200), limit):
+            legacy = combine_parts_legacy(split_text_legacy(text, message_size_limit), message_size_limit)
+            assert list(split_text_at_good_places(text, message_size_limit)) == legacy, "differs from legacy"
+        text = make_html_text(size, rng)
+        message_size_limit = rng.choice([300, 1000, limit])
+        check_html_chunks(text, list(split_text_at_good_places(text, message_size_limit)), message_size_limit)
+        text = make_stray_text(size, rng)
+        check_stray_chunks(text, list(split_text_at_good_places(text, limit)), limit)
+    print(f"checked {args.checks} random plain, html and stray \"<\" texts")
+
+    print(f"{'text':<8} {'chars':>9} {'chunks':>7} {'legacy, s':>10} {'single-pass, s':>15}")
+    for name, make in (("plain", make_plain_text), ("html", make_html_text), ("stray", make_stray_text)):
+        text = make(args.size, rng)
+        legacy_time, legacy = timed(
+            lambda: combine_parts_legacy(split_text_legacy(text, limit), limit),
+        )
+        new_time, chunks = timed(lambda: list(split_text_at_good_places(text, limit)))
+        print(f"{name:<8} {len(text):>9} {len(chunks):>7} {legacy_time:>10.2f} {new_time:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Offline benchmark of update-to-handler latency of polling and webhook modes
+
+    python -m benchmarks.update_delivery --updates 200 --rtt 0.05
+
+Updates appear at Telegram every `--interval` seconds. In polling mode they
+are long polled from `FakeBot` the way `run_polling` does it, in webhook mode
+they are posted to the local webhook server started the way `run_webhook`
+does it. The time from an update appearing until the first handler of the
+application sees it is measured, handlers of both modes are the same
+"""
+from typing import Any, Awaitable, Callable, Dict, List
+from collections import Counter
+import argparse
+import asyncio
+import json
+import logging
+import random
+import socket
+import time
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from bot.app import build_application
+from bot.services import services
+from benchmarks.fakes import FakeBot, FakeCollection
+from benchmarks.handlers import UpdateFactory, percentile, seed
+
+
+SECRET_TOKEN = "benchmark-secret"
+WEBHOOK_PATH = "webhook"
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def measure(
+    application: Application,
+    factory: UpdateFactory,
+    deliver: Callable[[Dict[str, Any]], Awaitable[None]],
+    args: argparse.Namespace,
+    rng: random.Random,
+) -> List[float]:
+    sent_at: Dict[int, float] = {}
+    latencies: List[float] = []
+    done = asyncio.Event()
+
+    async def record(update: Update, context: Any) -> None:
+        latencies.append(time.perf_counter() - sent_at[update.update_id])
+        if len(latencies) == args.updates:
+            done.set()
+
+    # before the handlers of the bot, right when the update is dispatched
+    application.add_handler(TypeHandler(Update, record), group=-1)
+    deliveries = []
+    for _ in range(args.updates):
+        user_id = rng.choice(factory.user_ids)
+        update = factory.command(user_id, rng.choice(["/start", "/open"])).to_dict()
+        sent_at[update["update_id"]] = time.perf_counter()
+        deliveries.append(asyncio.ensure_future(deliver(update)))
+        await asyncio.sleep(args.interval)
+    await asyncio.gather(*deliveries)
+    await asyncio.wait_for(done.wait(), timeout=args.poll_timeout + 10)
+    return latencies
+
+
+async def run_polling(args: argparse.Namespace, user_ids: List[int], rng: random.Random) -> List[float]:
+    fake_bot = FakeBot(Counter(), latency=args.rtt)
+    application = build_application(bot=fake_bot)
+    factory = UpdateFactory(fake_bot, [], user_ids)
+
+    async def deliver(update: Dict[str, Any]) -> None:
+        fake_bot.push_update(update)
+
+    await application.initialize()
+    # same arguments as `Application.run_polling` uses by default
+    await application.updater.start_polling(poll_interval=0.0, timeout=args.poll_timeout)
+    await application.start()
+    try:
+        return await measure(application, factory, deliver, args, rng)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+
+
+async def run_webhook(args: argparse.Namespace, user_ids: List[int], rng: random.Random) -> List[float]:
+    fake_bot = FakeBot(Counter(), latency=args.rtt)
+    application = build_application(bot=fake_bot)
+    factory = UpdateFactory(fake_bot, [], user_ids)
+    port = get_free_port()
+    client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}")
+
+    async def deliver(update: Dict[str, Any]) -> None:
+        # Telegram is `rtt / 2` away
+        await asyncio.sleep(args.rtt / 2)
+        response = await client.post(
+            f"/{WEBHOOK_PATH}",
+            content=json.dumps(update),
+            headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN},
+        )
+        response.raise_for_status()
+
+    await application.initialize()
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=port,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"http://127.0.0.1:{port}/{WEBHOOK_PATH}",
+        secret_token=SECRET_TOKEN,
+    )
+    await application.start()
+    try:
+        return await measure(application, factory, deliver, args, rng)
+    finally:
+        await client.aclose()
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+
+
+async def run(args: argparse.Namespace) -> None:
+    operations = Counter()
+    for name in ("user", "barrier", "event", "usage"):
+        setattr(services.db, f"{name}_collection", FakeCollection(name, operations, latency=args.db_latency))
+    _, user_ids = seed(args.users, args.barriers, args.barriers_per_user, random.Random(args.seed))
+
+    header = f"{'mode':<8} {'count':>6} {'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8} {'max, ms':>8}"
+    print(f"updates: {args.updates}, interval: {args.interval * 1e3:.0f} ms, round trip: {args.rtt * 1e3:.0f} ms")
+    print(header)
+    print("-" * len(header))
+    for mode, run_mode in (("polling", run_polling), ("webhook", run_webhook)):
+        latencies = await run_mode(args, user_ids, random.Random(args.seed))
+        print(
+            f"{mode:<8} {len(latencies):>6} "
+            f"{percentile(latencies, 50) * 1e3:>8.2f} {percentile(latencies, 95) * 1e3:>8.2f} "
+            f"{percentile(latencies, 99) * 1e3:>8.2f} {max(latencies) * 1e3:>8.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between updates")
+    parser.add_argument("--rtt", type=float, default=0.05, help="seconds of a round trip to Telegram")
+    parser.add_argument("--poll-timeout", type=int, default=10, help="getUpdates long polling timeout")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--barriers", type=int, default=20)
+    parser.add_argument("--barriers-per-user", type=int, default=3)
+    parser.add_argument("--db-latency", type=float, default=0.001, help="seconds per mongo round trip")
+    parser.add_argument("--seed", type=int, default=0)
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
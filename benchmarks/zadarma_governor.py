@@ -0,0 +1,142 @@
+"""
+Check of `ZadarmaGovernor` retries and circuit breaker against a local fake
+Zadarma server, offline:
+
+    python -m benchmarks.zadarma_governor
+
+Callback requests are paid, so only requests that never reached Zadarma and
+429/503 answers are sent again. Read timeouts and other errors count towards
+the circuit breaker, which rejects calls right away until `recovery_timeout`
+passes and then lets a single trial call through
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from benchmarks.fakes import FakeZadarmaServer
+from bot.errors import ZadarmaUnavailableError
+from bot.zadarma.api import AsyncZadarmaAPI
+from bot.zadarma.governor import ZadarmaGovernor
+
+
+METHOD = "/v1/request/callback/"
+
+
+def make_governor(server: FakeZadarmaServer, args: argparse.Namespace, read_timeout: float = 5.0) -> ZadarmaGovernor:
+    api = AsyncZadarmaAPI(key="key", secret="secret", read_timeout=read_timeout, url_api=server.url)
+    return ZadarmaGovernor(
+        api,
+        rate_limit_per_minute=1e9,
+        max_attempts=args.max_attempts,
+        failure_threshold=args.failure_threshold,
+        recovery_timeout=args.recovery_timeout,
+    )
+
+
+async def call(governor: ZadarmaGovernor) -> str:
+    return await governor.call(METHOD, {"from": "+70000000000", "to": "+70000000001"})
+
+
+async def check_retry_after_unavailable(args: argparse.Namespace) -> None:
+    with FakeZadarmaServer(statuses=[503]) as server:
+        governor = make_governor(server, args)
+        await call(governor)
+        await governor.api.close()
+    assert len(server.requests) == 2, server.requests
+    assert not governor.breaker.is_open
+    print(f"503 then 200: recovered after {len(server.requests)} requests")
+
+
+async def check_no_retry_on_client_error(args: argparse.Namespace) -> None:
+    with FakeZadarmaServer(status=400) as server:
+        governor = make_governor(server, args)
+        try:
+            await call(governor)
+            raise AssertionError("400 must be raised")
+        except httpx.HTTPStatusError as e:
+            assert e.response.status_code == 400
+        await governor.api.close()
+    assert len(server.requests) == 1, server.requests
+    assert governor.breaker.failures == 0
+    print(f"400: {len(server.requests)} request, not counted as failure")
+
+
+async def check_no_retry_on_read_timeout(args: argparse.Namespace) -> None:
+    with FakeZadarmaServer(latency=0.5) as server:
+        governor = make_governor(server, args, read_timeout=0.2)
+        try:
+            await call(governor)
+            raise AssertionError("read timeout must be raised")
+        except ZadarmaUnavailableError:
+            pass
+        await governor.api.close()
+        # let the server finish answering before it is shut down
+        await asyncio.sleep(0.5)
+    assert len(server.requests) == 1, server.requests
+    assert governor.breaker.failures == 1
+    print(f"read timeout: {len(server.requests)} request, counted as failure")
+
+
+async def check_circuit_breaker(args: argparse.Namespace) -> None:
+    with FakeZadarmaServer(status=500) as server:
+        governor = make_governor(server, args)
+        for _ in range(args.failure_threshold):
+            try:
+                await call(governor)
+                raise AssertionError("500 must be raised")
+            except ZadarmaUnavailableError:
+                pass
+        # 500 is not retried, every call is a single request
+        assert len(server.requests) == args.failure_threshold, server.requests
+        assert governor.breaker.is_open
+
+        started_at = time.perf_counter()
+        try:
+            await call(governor)
+            raise AssertionError("open circuit must reject calls")
+        except ZadarmaUnavailableError:
+            pass
+        rejected_in = time.perf_counter() - started_at
+        assert len(server.requests) == args.failure_threshold, server.requests
+        print(
+            f"{args.failure_threshold} failures opened the circuit, "
+            f"next call rejected in {rejected_in * 1e3:.2f} ms without a request"
+        )
+
+        await asyncio.sleep(args.recovery_timeout)
+        server.status = 200
+        server.latency = 0.1
+        trial = asyncio.ensure_future(call(governor))
+        await asyncio.sleep(0.02)
+        try:
+            # only one trial call goes through while the circuit is half open
+            await call(governor)
+            raise AssertionError("calls during the trial must be rejected")
+        except ZadarmaUnavailableError:
+            pass
+        await trial
+        await governor.api.close()
+    assert len(server.requests) == args.failure_threshold + 1, server.requests
+    assert not governor.breaker.is_open
+    print(f"after {args.recovery_timeout} s a single trial call went through and closed the circuit")
+
+
+async def run(args: argparse.Namespace) -> None:
+    await check_retry_after_unavailable(args)
+    await check_no_retry_on_client_error(args)
+    await check_no_retry_on_read_timeout(args)
+    await check_circuit_breaker(args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--failure-threshold", type=int, default=5)
+    parser.add_argument("--recovery-timeout", type=float, default=0.5)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
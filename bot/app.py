@@ -1,6 +1,8 @@
 from typing import Optional
+from functools import partial
 import logging
 
+from telegram import Bot
 from telegram.ext import (
     Application,
     ApplicationBuilder,
@@ -8,12 +10,16 @@ from telegram.ext import (
     MessageHandler,
     ChatMemberHandler,
     CallbackQueryHandler,
+    CallbackContext,
     filters,
     AIORateLimiter,
 )
 
 from bot import config
+from bot import metrics
+from bot.services import services
 import bot.handlers.manage_data as md
+from bot.handlers.utils import make_callback_query_router
 from bot.handlers.help import (
     start_handle,
     help_handle,
@@ -22,34 +28,125 @@ from bot.handlers.general import (
     error_handle,
     default_callback_handle,
 )
+from bot.handlers.error import flush_error_reports
 from bot.handlers.admin import (
     user_contact_handler,
     choose_role_handler,
     give_access_handler,
+    barrier_access_page_handler,
+    barrier_users_handler,
+    history_handler,
+    history_page_handler,
+    stats_handler,
+    grant_access_handler,
+    revoke_access_handler,
+    export_handler,
+    import_handler,
 )
 from bot.handlers.main import (
     add_barrier_handler,
     show_barriers_handler,
     open_barrier_handler,
+    barriers_page_handler,
+    report_call_outcome,
 )
 
 
 logger = logging.getLogger(__name__)
 
 
-def run_bot() -> None:
+async def flush_profile_updates_job(context: CallbackContext) -> None:
+    try:
+        await services.db.flush_profile_updates()
+    except Exception:
+        logger.exception("Could not flush user profile updates")
+
+
+async def flush_events_job(context: CallbackContext) -> None:
+    try:
+        await services.db.flush_events()
+    except Exception:
+        logger.exception("Could not flush barrier open events")
+    try:
+        await services.db.flush_usage()
+    except Exception:
+        logger.exception("Could not flush usage counters")
+
+
+async def flush_error_reports_job(context: CallbackContext) -> None:
+    await flush_error_reports(context.bot)
+
+
+async def post_init(application: Application) -> None:
+    if config.metrics_port:
+        metrics.start_metrics_server(config.metrics_port, addr=config.metrics_listen)
+    await services.db.create_indexes()
+    # build clients now rather than on the first update
+    services.open_dispatcher
+    application.job_queue.run_repeating(
+        flush_profile_updates_job,
+        interval=config.profile_flush_interval,
+    )
+    application.job_queue.run_repeating(
+        flush_events_job,
+        interval=config.event_flush_interval,
+    )
+    application.job_queue.run_repeating(
+        flush_error_reports_job,
+        interval=config.error_report_interval,
+    )
+    # writes of other workers and mongo-express reach caches through change streams or polling
+    services.cache_watcher.start()
+    if config.zadarma_notifications_port:
+        services.notification_receiver.start(on_call_end=partial(report_call_outcome, application.bot))
+
+
+async def post_shutdown(application: Application) -> None:
+    # every flush is tried even if mongo or Telegram is down, clients are closed anyway
+    try:
+        await services.db.flush_profile_updates()
+    except Exception:
+        logger.exception("Could not flush user profile updates")
+    try:
+        await services.db.flush_events()
+    except Exception:
+        logger.exception("Could not flush barrier open events")
+    try:
+        await services.db.flush_usage()
+    except Exception:
+        logger.exception("Could not flush usage counters")
+    try:
+        await flush_error_reports(application.bot)
+    except Exception:
+        logger.exception("Could not flush error reports")
+    await services.close()
+
+
+def build_application(bot: Optional[Bot] = None) -> Application:
+    """
+    :param bot: prebuilt bot to use instead of connecting with `config.telegram_token`
+    """
+    builder = ApplicationBuilder()
+    if bot is None:
+        builder = (
+            builder
+            # .base_url('http://bot-api:8081/bot')
+            # .local_mode(True)
+            # .base_file_url('http://bot-api:8081/file/bot')
+            .token(config.telegram_token)
+            .rate_limiter(AIORateLimiter(max_retries=3))
+            .http_version("1.1")
+            .get_updates_http_version("1.1")
+            .read_timeout(60)
+            .write_timeout(60)
+        )
+    else:
+        builder = builder.bot(bot)
     application = (
-        ApplicationBuilder()
-        # .base_url('http://bot-api:8081/bot')
-        # .local_mode(True)
-        # .base_file_url('http://bot-api:8081/file/bot')
-        .token(config.telegram_token)
+        builder
         .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=3))
-        .http_version("1.1")
-        .get_updates_http_version("1.1")
-        .read_timeout(60)
-        .write_timeout(60)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -67,14 +164,55 @@ def run_bot() -> None:
         CommandHandler("start", start_handle, filters=user_filter),
         CommandHandler("help", help_handle, filters=user_filter),
         MessageHandler(filters=filters.CONTACT, callback=user_contact_handler),
-        CallbackQueryHandler(choose_role_handler, pattern=md.ChooseRoleData.pattern()),
-        CallbackQueryHandler(give_access_handler, pattern=md.BarrierAccessData.pattern()),
         CommandHandler("add_barrier", add_barrier_handler, filters=user_filter),
+        CommandHandler("barrier_users", barrier_users_handler, filters=user_filter),
+        CommandHandler("history", history_handler, filters=user_filter),
+        CommandHandler("stats", stats_handler, filters=user_filter),
+        CommandHandler("grant", grant_access_handler, filters=user_filter),
+        CommandHandler("revoke", revoke_access_handler, filters=user_filter),
+        # whole collections, so only for admins from config
+        CommandHandler("export", export_handler, filters=admin_filter),
+        CommandHandler("import", import_handler, filters=admin_filter),
+        MessageHandler(
+            filters=filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)") & admin_filter,
+            callback=import_handler,
+        ),
         CommandHandler("open", show_barriers_handler, filters=user_filter),
-        CallbackQueryHandler(open_barrier_handler, pattern=md.BarrierData.pattern()),
     ]
+    callback_query_handlers = {
+        md.ChooseRoleData.prefix: choose_role_handler,
+        md.BarrierAccessData.prefix: give_access_handler,
+        md.BarrierData.prefix: open_barrier_handler,
+        md.HistoryData.prefix: history_page_handler,
+        md.BarriersPageData.prefix: barriers_page_handler,
+        md.BarrierAccessPageData.prefix: barrier_access_page_handler,
+    }
 
     application.add_handlers(handlers)
-    application.add_handler(CallbackQueryHandler(default_callback_handle))
+    application.add_handler(CallbackQueryHandler(
+        make_callback_query_router(callback_query_handlers, default=default_callback_handle),
+    ))
     application.add_error_handler(error_handle)
-    application.run_polling()
+    return application
+
+
+def run_bot() -> None:
+    config.load()
+    if config.workers > 1 and config.mode != "webhook":
+        # Telegram answers concurrent getUpdates of the same token with 409 Conflict
+        raise ValueError(f"workers > 1 requires webhook mode, got {config.mode}")
+    application = build_application()
+    if config.mode == "polling":
+        application.run_polling()
+    elif config.mode == "webhook":
+        if not config.webhook_url or not config.webhook_secret_token:
+            raise ValueError("You must specify webhook_url and webhook_secret_token in config for webhook mode")
+        application.run_webhook(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=config.webhook_path,
+            webhook_url=config.webhook_url,
+            secret_token=config.webhook_secret_token,
+        )
+    else:
+        raise ValueError(f"Unknown mode {config.mode}, must be either polling or webhook")
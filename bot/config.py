@@ -7,21 +7,71 @@ config_dir = Path(__file__).parent.parent.resolve() / "config"
 bot_dir = Path(__file__).parent.parent.resolve() / "bot"
 
 
-# load yaml config
-with open(config_dir / "config.yml", "r") as f:
-    config_yaml = yaml.safe_load(f)
-
-
-# config parameters
-telegram_token = config_yaml["telegram_token"]
-allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
-admin_chat_id = config_yaml["admin_chat_id"]
-admin_usernames = config_yaml["admin_usernames"]
-mongodb_uri = f"mongodb://mongo:27017"
-support_username = config_yaml["support_username"]
-bot_username = config_yaml["bot_username"]
-bot_name = config_yaml["bot_name"]
-zadarma_api_key = config_yaml["zadarma_api_key"]
-zadarma_api_secret = config_yaml["zadarma_api_secret"]
-zadarma_number = config_yaml["zadarma_number"]
-zadarma_sip = config_yaml["zadarma_sip"]
+def load(path: Path = config_dir / "config.yml") -> None:
+    """
+    Reads config parameters into module attributes. Called by `run_bot`,
+    or implicitly on first access to a parameter, so importing is free
+    """
+    global loaded
+    with open(path, "r") as f:
+        config_yaml = yaml.safe_load(f)
+
+    # config parameters
+    globals().update(dict(
+        telegram_token=config_yaml["telegram_token"],
+        allowed_telegram_usernames=config_yaml["allowed_telegram_usernames"],
+        admin_chat_id=config_yaml["admin_chat_id"],
+        admin_usernames=config_yaml["admin_usernames"],
+        mongodb_uri=f"mongodb://mongo:27017",
+        support_username=config_yaml["support_username"],
+        bot_username=config_yaml["bot_username"],
+        bot_name=config_yaml["bot_name"],
+        zadarma_api_key=config_yaml["zadarma_api_key"],
+        zadarma_api_secret=config_yaml["zadarma_api_secret"],
+        zadarma_number=config_yaml["zadarma_number"],
+        zadarma_sip=config_yaml["zadarma_sip"],
+        user_cache_size=config_yaml.get("user_cache_size", 10000),
+        user_cache_ttl=config_yaml.get("user_cache_ttl", 300),
+        profile_flush_interval=config_yaml.get("profile_flush_interval", 10),
+        barrier_cache_size=config_yaml.get("barrier_cache_size", 10000),
+        barrier_cache_ttl=config_yaml.get("barrier_cache_ttl", 3600),
+        zadarma_connect_timeout=config_yaml.get("zadarma_connect_timeout", 3.0),
+        zadarma_read_timeout=config_yaml.get("zadarma_read_timeout", 10.0),
+        barrier_open_coalesce_window=config_yaml.get("barrier_open_coalesce_window", 5.0),
+        zadarma_rate_limit_per_minute=config_yaml.get("zadarma_rate_limit_per_minute", 100),
+        zadarma_max_attempts=config_yaml.get("zadarma_max_attempts", 3),
+        zadarma_circuit_failure_threshold=config_yaml.get("zadarma_circuit_failure_threshold", 5),
+        zadarma_circuit_recovery_timeout=config_yaml.get("zadarma_circuit_recovery_timeout", 30.0),
+        mode=config_yaml.get("mode", "polling"),
+        webhook_url=config_yaml.get("webhook_url"),
+        webhook_listen=config_yaml.get("webhook_listen", "0.0.0.0"),
+        webhook_port=config_yaml.get("webhook_port", 8443),
+        webhook_path=config_yaml.get("webhook_path", ""),
+        webhook_secret_token=config_yaml.get("webhook_secret_token"),
+        keyboard_cache_size=config_yaml.get("keyboard_cache_size", 10000),
+        metrics_listen=config_yaml.get("metrics_listen", "127.0.0.1"),
+        metrics_port=config_yaml.get("metrics_port"),
+        workers=config_yaml.get("workers", 1),
+        cache_sync_interval=config_yaml.get("cache_sync_interval", 5),
+        barrier_open_wait_timeout=config_yaml.get("barrier_open_wait_timeout", 30.0),
+        error_report_interval=config_yaml.get("error_report_interval", 30),
+        event_flush_interval=config_yaml.get("event_flush_interval", 5),
+        event_ttl_days=config_yaml.get("event_ttl_days", 90),
+        zadarma_notifications_listen=config_yaml.get("zadarma_notifications_listen", "0.0.0.0"),
+        zadarma_notifications_port=config_yaml.get("zadarma_notifications_port"),
+        zadarma_notifications_path=config_yaml.get("zadarma_notifications_path", "/zadarma"),
+        zadarma_call_outcome_timeout=config_yaml.get("zadarma_call_outcome_timeout", 120),
+        zadarma_utc_offset_hours=config_yaml.get("zadarma_utc_offset_hours", 3),
+    ))
+    loaded = True
+
+
+loaded = False
+
+
+def __getattr__(name: str) -> Any:
+    if not loaded and not name.startswith("__"):
+        load()
+        if name in globals():
+            return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,33 +1,140 @@
 from typing import Optional, Any, Dict, List, Tuple
+from collections import Counter
 from bson.objectid import ObjectId
 
+import copy
 import logging
-import pymongo
-from datetime import datetime
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from motor.motor_asyncio import AsyncIOMotorClient
+from datetime import datetime, timedelta
 
 from bot import config
+from bot import metrics
+from bot.cache import LRUCache
 from bot.handlers import manage_data as md
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)-12s :%(name)-30s: %(levelname)-8s %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 
 ChatId = UserId = MessageId = int
 NewsletterId = str
 
+# fields of the user document kept in the in-process profile cache
+USER_PROFILE_FIELDS = ("role", "barriers", "username", "first_name", "last_name")
+USER_PROFILE_PROJECTION = {key: 1 for key in USER_PROFILE_FIELDS}
+# events kept in memory while mongo is unavailable, older ones are dropped
+MAX_PENDING_EVENTS = 10000
+# seconds expired pending calls are kept in case their timeout job is late
+PENDING_CALL_CLEANUP_DELAY = 3600
 
+
+@metrics.instrument_database
 class Database:
-    def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
-        self.db = self.client["bot"]
+    def __init__(self, uri: Optional[str] = None, name: str = "bot"):
+        self.client = AsyncIOMotorClient(uri or config.mongodb_uri)
+        self.db = self.client[name]
         self.user_collection = self.db["user"]
         self.barrier_collection = self.db["barrier"]
+        self.state_collection = self.db["state"]
+        self.barrier_open_lease_collection = self.db["barrier_open_lease"]
+        self.event_collection = self.db["event"]
+        self.usage_collection = self.db["usage"]
+        self.pending_call_collection = self.db["pending_call"]
+        self.user_cache = LRUCache(maxsize=config.user_cache_size, ttl=config.user_cache_ttl)
+        self.pending_profile_updates: Dict[UserId, Dict[str, Any]] = {}
+        self.pending_events: List[Dict[str, Any]] = []
+        # $inc of usage rollups by (barrier_id, day), see `flush_usage`
+        self.pending_usage: Dict[Tuple[ObjectId, datetime], Counter] = {}
+        self.barrier_cache = LRUCache(maxsize=config.barrier_cache_size, ttl=config.barrier_cache_ttl)
+        # bumped on every change of barrier documents, invalidates derived data like keyboards
+        self.barriers_version = 0
+        # version of users and barriers shared by all workers, see `sync_caches`
+        self.shared_version: Optional[int] = None
+
+    async def _bump_shared_version(self):
+        """Makes other workers drop their caches on the next `sync_caches`"""
+        if config.workers <= 1:
+            return
+        state = await self.state_collection.find_one_and_update(
+            {"_id": "cache"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if self.shared_version is not None and state["version"] == self.shared_version + 1:
+            # nobody else wrote in between, own caches are up to date
+            self.shared_version = state["version"]
+
+    async def sync_caches(self):
+        """Drops cached users and barriers if another worker changed them"""
+        state = await self.state_collection.find_one({"_id": "cache"})
+        version = state["version"] if state is not None else 0
+        if self.shared_version is not None and version != self.shared_version:
+            logger.info(f"Shared version changed {self.shared_version} -> {version}, dropping caches")
+            self.drop_caches()
+        self.shared_version = version
+
+    def drop_caches(self):
+        self.user_cache.clear()
+        self.barrier_cache.clear()
+        self.barriers_version += 1
+
+    def refresh_cached_user(self, user_id: UserId, user: Optional[Dict[str, Any]]):
+        """Patches the cached profile with `user` changed elsewhere, drops it if `user` is None"""
+        if user is None or self.user_cache.get(user_id) is None:
+            # not cached users are read on demand anyway
+            self.user_cache.pop(user_id)
+            return
+        self._cache_user({key: user[key] for key in ("_id", *USER_PROFILE_FIELDS) if key in user})
+
+    def refresh_cached_barrier(self, barrier_id: ObjectId):
+        self.barrier_cache.pop(barrier_id)
+        self.barriers_version += 1
 
-    def add_or_update_user(
+    async def create_indexes(self):
+        # multikey index, answers "which users can open barrier X"
+        await self.user_collection.create_index("barriers")
+        await self.user_collection.create_index("username")
+        await self.user_collection.create_index("role")
+        # pages of `get_barrier_events`
+        await self.event_collection.create_index([("barrier_id", 1), ("timestamp", -1), ("_id", -1)])
+        await self._create_event_ttl_index()
+        await self.usage_collection.create_index([("barrier_id", 1), ("day", 1)])
+        await self.pending_call_collection.create_index("phone_number")
+        # expired calls are reported by `call_outcome_timeout_job`, the TTL only
+        # removes ones left behind by workers stopped meanwhile
+        await self.pending_call_collection.create_index("expires_at", expireAfterSeconds=PENDING_CALL_CLEANUP_DELAY)
+
+    async def _create_event_ttl_index(self):
+        expire_after_seconds = int(config.event_ttl_days * 24 * 3600)
+        try:
+            await self.event_collection.create_index("timestamp", expireAfterSeconds=expire_after_seconds)
+        except OperationFailure:
+            # index exists with another ttl, change it in place
+            await self.db.command(
+                "collMod",
+                self.event_collection.name,
+                index={"keyPattern": {"timestamp": 1}, "expireAfterSeconds": expire_after_seconds},
+            )
+
+    async def get_user(self, user_id: UserId) -> Optional[Dict[str, Any]]:
+        """Returns cached user profile (see `USER_PROFILE_FIELDS`), must not be mutated"""
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = await self.user_collection.find_one({"_id": user_id}, USER_PROFILE_PROJECTION)
+            if user is not None:
+                user = self._cache_user(user)
+        return user
+
+    def _cache_user(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        # profile changes waiting for `flush_profile_updates` are newer than mongo
+        user = {**user, **self.pending_profile_updates.get(user["_id"], {})}
+        self.user_cache.set(user["_id"], user)
+        return user
+
+    async def add_or_update_user(
         self,
         user_id: UserId,
         *,
@@ -48,14 +155,174 @@ class Database:
         if last_name is not None:
             user_dict["last_name"] = last_name
 
-        self.user_collection.update_one(
+        await self.user_collection.update_one(
             {"_id": user_id},
             {"$set": user_dict},
             upsert=True,
         )
+        cached_user = self.user_cache.get(user_id)
+        if cached_user is not None:
+            self.user_cache.set(user_id, {**cached_user, **user_dict})
+        if role is not None:
+            await self._bump_shared_version()
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False) -> bool:
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+    async def update_user_profile(
+        self,
+        user_id: UserId,
+        *,
+        username: Optional[str] = None,
+        first_name: Optional[str] = None,
+        last_name: Optional[str] = None,
+    ):
+        """
+        Same as `add_or_update_user` for telegram profile fields, but skips no-op updates
+        and buffers real changes of existing users until `flush_profile_updates`
+        """
+        profile = {
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+        }
+        profile = {key: value for key, value in profile.items() if value is not None}
+        user = await self.get_user(user_id)
+        if user is None:
+            await self.add_or_update_user(user_id, **profile)
+            return
+        changes = {key: value for key, value in profile.items() if user.get(key) != value}
+        if not changes:
+            return
+        self.pending_profile_updates.setdefault(user_id, {}).update(changes)
+        self.user_cache.set(user_id, {**user, **changes})
+
+    async def flush_profile_updates(self):
+        if not self.pending_profile_updates:
+            return
+        pending, self.pending_profile_updates = self.pending_profile_updates, {}
+        requests = [
+            UpdateOne({"_id": user_id}, {"$set": changes}, upsert=True)
+            for user_id, changes in pending.items()
+        ]
+        try:
+            await self.user_collection.bulk_write(requests, ordered=False)
+        except Exception:
+            # keep changes for the next flush unless newer ones arrived meanwhile
+            for user_id, changes in pending.items():
+                newer_changes = self.pending_profile_updates.get(user_id, {})
+                self.pending_profile_updates[user_id] = {**changes, **newer_changes}
+            raise
+        logger.info(f"Flushed profile updates of {len(requests)} users")
+
+    def add_barrier_open_event(
+        self,
+        *,
+        user_id: UserId,
+        barrier_id: ObjectId,
+        latency: float,
+        status: str,
+        timestamp: Optional[datetime] = None,
+    ):
+        """Buffers the event until `flush_events` and its counters until `flush_usage`, never waits for mongo"""
+        timestamp = timestamp or datetime.utcnow()
+        self.pending_events.append({
+            "user_id": user_id,
+            "barrier_id": barrier_id,
+            "timestamp": timestamp,
+            "latency": round(latency, 3),
+            "status": status,
+        })
+        if len(self.pending_events) > MAX_PENDING_EVENTS:
+            del self.pending_events[:-MAX_PENDING_EVENTS]
+
+        day = datetime(timestamp.year, timestamp.month, timestamp.day)
+        usage = self.pending_usage.setdefault((barrier_id, day), Counter())
+        usage["count"] += 1
+        usage[f"hours.{timestamp.hour}"] += 1
+        usage[f"users.{user_id}"] += 1
+        if status != "success":
+            usage["failed"] += 1
+
+    async def flush_events(self):
+        if not self.pending_events:
+            return
+        pending, self.pending_events = self.pending_events, []
+        try:
+            await self.event_collection.insert_many(pending, ordered=False)
+        except BulkWriteError as e:
+            # duplicates were written by an earlier flush that failed midway
+            failed = {x["index"] for x in e.details.get("writeErrors", []) if x.get("code") != 11000}
+            if failed or e.details.get("writeConcernErrors"):
+                self._requeue_events([x for i, x in enumerate(pending) if i in failed])
+                raise
+        except Exception:
+            self._requeue_events(pending)
+            raise
+        logger.info(f"Flushed {len(pending)} events")
+
+    def _requeue_events(self, events: List[Dict[str, Any]]):
+        # failed events go before the ones that arrived meanwhile
+        self.pending_events = (events + self.pending_events)[-MAX_PENDING_EVENTS:]
+
+    async def flush_usage(self):
+        """Adds counters of buffered opens to one rollup document per barrier and day"""
+        if not self.pending_usage:
+            return
+        pending, self.pending_usage = self.pending_usage, {}
+        keys = list(pending)
+        requests = [
+            UpdateOne(
+                {"_id": f"{barrier_id}:{day:%Y-%m-%d}"},
+                {"$inc": dict(pending[barrier_id, day]), "$setOnInsert": {"barrier_id": barrier_id, "day": day}},
+                upsert=True,
+            )
+            for barrier_id, day in keys
+        ]
+        try:
+            await self.usage_collection.bulk_write(requests, ordered=False)
+        except Exception as e:
+            if isinstance(e, BulkWriteError):
+                # the rest are applied, retrying them would count twice
+                failed = {x["index"] for x in e.details.get("writeErrors", [])}
+                keys = [x for i, x in enumerate(keys) if i in failed]
+            for key in keys:
+                self.pending_usage.setdefault(key, Counter()).update(pending[key])
+            raise
+
+    async def get_usage(
+        self,
+        barrier_ids: List[ObjectId],
+        *,
+        since: datetime,
+    ) -> List[Dict[str, Any]]:
+        """Returns rollups of the barriers for days from `since`, one per barrier and day"""
+        cursor = self.usage_collection.find({"barrier_id": {"$in": barrier_ids}, "day": {"$gte": since}})
+        return await cursor.to_list(length=None)
+
+    async def get_barrier_events(
+        self,
+        barrier_id: ObjectId,
+        *,
+        before: Optional[datetime] = None,
+        before_id: Optional[ObjectId] = None,
+        limit: int = 20,
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns up to `limit` latest events of the barrier before the event with
+        `before` timestamp and `before_id`, newest first. Events are ordered by
+        (timestamp, _id), so events of the same millisecond are not skipped between pages
+        """
+        query: Dict[str, Any] = {"barrier_id": barrier_id}
+        if before is not None and before_id is not None:
+            query["$or"] = [
+                {"timestamp": {"$lt": before}},
+                {"timestamp": before, "_id": {"$lt": before_id}},
+            ]
+        elif before is not None:
+            query["timestamp"] = {"$lt": before}
+        cursor = self.event_collection.find(query).sort([("timestamp", -1), ("_id", -1)]).limit(limit)
+        return await cursor.to_list(length=None)
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False) -> bool:
+        if await self.get_user(user_id) is not None:
             return True
         else:
             if raise_exception:
@@ -63,11 +330,14 @@ class Database:
             else:
                 return False
 
-    def set_user_attribute(self, user_id: UserId, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    async def set_user_attribute(self, user_id: UserId, key: str, value: Any):
+        result = await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        self.user_cache.pop(user_id)
+        if result.matched_count == 0:
+            raise ValueError(f"User {user_id} does not exist")
+        await self._bump_shared_version()
 
-    def get_user_attribute(
+    async def get_user_attribute(
         self,
         user_id: int,
         key: str,
@@ -75,38 +345,42 @@ class Database:
         raise_exception: bool = False,
         default: Optional[Any] = None,
     ) -> Any:
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+        if key in USER_PROFILE_FIELDS:
+            user_dict = await self.get_user(user_id)
+        else:
+            user_dict = await self.user_collection.find_one({"_id": user_id}, {key: 1})
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
         if key not in user_dict:
             if raise_exception:
                 raise KeyError(f"Key {key} does not exist for user {user_id}")
             else:
                 return default
-        return user_dict[key]
+        return copy.copy(user_dict[key])
 
-    def get_user_role(
+    async def get_user_role(
         self,
         user_id: UserId,
     ) -> Optional[md.Role]:
-        user = self.user_collection.find_one({"_id": user_id})
+        user = await self.get_user(user_id)
         if user is None:
             return None
         if user.get("role") is None:
             return md.Role.BANNED
         return md.Role(user["role"])
     
-    def is_user_allowed_to_open_barrier(
+    async def is_user_allowed_to_open_barrier(
         self,
         user_id: UserId,
     ) -> bool:
-        user = self.user_collection.find_one({"_id": user_id})
+        user = await self.get_user(user_id)
         if user is None or user.get("role") in (None, md.Role.BANNED.value):
             return False
         if user["role"] in (md.Role.ADMIN.value, md.Role.USER.value):
             return True
         return False
     
-    def add_barrier(
+    async def add_barrier(
         self,
         *,
         phone_number: str,
@@ -116,53 +390,333 @@ class Database:
             "phone_number": phone_number,
             "name": name,
         }
-        return self.barrier_collection.insert_one(barrier_dict).inserted_id
+        result = await self.barrier_collection.insert_one(barrier_dict)
+        self.barrier_cache.set(result.inserted_id, barrier_dict)
+        self.barriers_version += 1
+        await self._bump_shared_version()
+        return result.inserted_id
+
+    async def _update_user_barriers(
+        self,
+        user_filter: Dict[str, Any],
+        update: Dict[str, Any],
+    ) -> Optional[List[ObjectId]]:
+        user = await self.user_collection.find_one_and_update(
+            user_filter,
+            update,
+            projection=USER_PROFILE_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+        if user is None:
+            return None
+        await self._bump_shared_version()
+        return copy.copy(self._cache_user(user).get("barriers", []))
 
-    def add_barrier_to_user(
+    async def add_barrier_to_user(
         self,
         *,
         barrier_id: ObjectId,
         user_id: UserId,
-    ):
-        barriers = self.get_user_attribute(user_id, "barriers", default=[])
-        barriers.append(barrier_id)
-        barriers = list(dict.fromkeys(barriers))
-        db.set_user_attribute(user_id, "barriers", barriers)
+    ) -> List[ObjectId]:
+        """Returns barriers of the user after the update"""
+        barriers = await self._update_user_barriers(
+            {"_id": user_id},
+            {"$addToSet": {"barriers": barrier_id}},
+        )
+        if barriers is None:
+            raise ValueError(f"User {user_id} does not exist")
+        return barriers
 
-    def remove_barrier_from_user(
+    async def remove_barrier_from_user(
         self,
         *,
         barrier_id: ObjectId,
         user_id: UserId,
-    ):
-        barriers = self.get_user_attribute(user_id, "barriers", default=[])
-        if barrier_id in barriers:
-            barriers = [x for x in barriers if x != barrier_id]
-            db.set_user_attribute(user_id, "barriers", barriers)
+    ) -> List[ObjectId]:
+        """Returns barriers of the user after the update"""
+        barriers = await self._update_user_barriers(
+            {"_id": user_id},
+            {"$pull": {"barriers": barrier_id}},
+        )
+        if barriers is None:
+            raise ValueError(f"User {user_id} does not exist")
+        return barriers
 
-    def switch_barrier_access_for_user(
+    async def switch_barrier_access_for_user(
         self,
         *,
         barrier_id: ObjectId,
         user_id: UserId,
-    ):
-        barriers = self.get_user_attribute(user_id, "barriers", default=[])
-        if barrier_id in barriers:
-            self.remove_barrier_from_user(barrier_id=barrier_id, user_id=user_id)
+    ) -> List[ObjectId]:
+        """Returns barriers of the user after the update"""
+        # both updates are conditional, so concurrent switches never get lost:
+        # if another switch wins in between, the loop retries against the new state
+        for _ in range(3):
+            barriers = await self._update_user_barriers(
+                {"_id": user_id, "barriers": barrier_id},
+                {"$pull": {"barriers": barrier_id}},
+            )
+            if barriers is None:
+                barriers = await self._update_user_barriers(
+                    {"_id": user_id, "barriers": {"$ne": barrier_id}},
+                    {"$addToSet": {"barriers": barrier_id}},
+                )
+            if barriers is not None:
+                return barriers
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        raise RuntimeError(f"Could not switch access to barrier {barrier_id} for user {user_id}")
+
+    async def set_barriers_access(
+        self,
+        *,
+        user_ids: List[UserId],
+        barrier_ids: List[ObjectId],
+        grant: bool,
+    ) -> Dict[UserId, List[ObjectId]]:
+        """
+        Grants or revokes `barrier_ids` for all `user_ids` with a single `bulk_write`.
+        Returns barriers actually added or removed by user, users without changes
+        and unknown users are skipped
+        """
+        users = await self.user_collection.find({"_id": {"$in": user_ids}}, {"barriers": 1}).to_list(length=None)
+        changes = {}
+        for user in users:
+            current_barriers = set(user.get("barriers", []))
+            changed_barriers = [x for x in barrier_ids if (x in current_barriers) != grant]
+            if changed_barriers:
+                changes[user["_id"]] = changed_barriers
+        if not changes:
+            return changes
+
+        if grant:
+            requests = [
+                UpdateOne({"_id": user_id}, {"$addToSet": {"barriers": {"$each": barriers}}})
+                for user_id, barriers in changes.items()
+            ]
         else:
-            self.add_barrier_to_user(barrier_id=barrier_id, user_id=user_id)
+            requests = [
+                UpdateOne({"_id": user_id}, {"$pull": {"barriers": {"$in": barriers}}})
+                for user_id, barriers in changes.items()
+            ]
+        try:
+            await self.user_collection.bulk_write(requests, ordered=False)
+        finally:
+            for user_id in changes:
+                self.user_cache.pop(user_id)
+        await self._bump_shared_version()
+        return changes
+
+    async def get_users_by_ids(
+        self,
+        user_ids: List[UserId],
+    ) -> Dict[UserId, Dict[str, Any]]:
+        """Returns cached user profiles by id with one query for the missing ones, skipping unknown users"""
+        users = {}
+        for user_id in user_ids:
+            user = self.user_cache.get(user_id)
+            if user is not None:
+                users[user_id] = user
+        missing_ids = [x for x in dict.fromkeys(user_ids) if x not in users]
+        if missing_ids:
+            async for user in self.user_collection.find({"_id": {"$in": missing_ids}}, USER_PROFILE_PROJECTION):
+                users[user["_id"]] = self._cache_user(user)
+        return users
+
+    async def get_user_ids_by_usernames(
+        self,
+        usernames: List[str],
+    ) -> Dict[str, UserId]:
+        cursor = self.user_collection.find({"username": {"$in": usernames}}, {"username": 1})
+        return {x["username"]: x["_id"] async for x in cursor}
 
-    def get_barriers(
+    def find_all(
+        self,
+        collection_name: str,
+        *,
+        batch_size: int,
+    ):
+        """Cursor over the whole `user` or `barrier` collection fetching `batch_size` documents per round trip"""
+        collection = getattr(self, f"{collection_name}_collection")
+        return collection.find({}).sort("_id", 1).batch_size(batch_size)
+
+    async def upsert_documents(
+        self,
+        collection_name: str,
+        documents: List[Dict[str, Any]],
+    ) -> Tuple[int, int]:
+        """
+        Sets fields of `user` or `barrier` documents by `_id`, inserting missing ones,
+        with a single `bulk_write`. Returns numbers of matched and inserted documents
+        """
+        collection = getattr(self, f"{collection_name}_collection")
+        requests = [
+            UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": {key: value for key, value in document.items() if key != "_id"}},
+                upsert=True,
+            )
+            for document in documents
+        ]
+        try:
+            result = await collection.bulk_write(requests, ordered=False)
+        finally:
+            self.drop_caches()
+        await self._bump_shared_version()
+        return result.matched_count, result.upserted_count
+
+    async def get_barriers(
         self,
     ) -> List[Dict[str, Any]]:
         barriers = self.barrier_collection.find()
-        return list(barriers)
+        return await barriers.to_list(length=None)
     
-    def get_barrier(
+    async def get_barrier(
         self,
         barrier_id: ObjectId,
     ) -> Optional[Dict[str, Any]]:
-        barrier = self.barrier_collection.find_one({"_id": barrier_id})
+        barrier = self.barrier_cache.get(barrier_id)
+        if barrier is None:
+            barrier = await self.barrier_collection.find_one({"_id": barrier_id})
+            if barrier is not None:
+                self.barrier_cache.set(barrier_id, barrier)
         return barrier
 
-db = Database()
+    async def get_barriers_by_ids(
+        self,
+        barrier_ids: List[ObjectId],
+    ) -> List[Dict[str, Any]]:
+        """Returns barriers in the order of `barrier_ids`, skipping missing ones"""
+        barriers = {}
+        for barrier_id in barrier_ids:
+            barrier = self.barrier_cache.get(barrier_id)
+            if barrier is not None:
+                barriers[barrier_id] = barrier
+        missing_ids = [x for x in dict.fromkeys(barrier_ids) if x not in barriers]
+        if missing_ids:
+            async for barrier in self.barrier_collection.find({"_id": {"$in": missing_ids}}):
+                self.barrier_cache.set(barrier["_id"], barrier)
+                barriers[barrier["_id"]] = barrier
+        return [barriers[x] for x in barrier_ids if x in barriers]
+
+    async def get_users_for_barrier(
+        self,
+        barrier_id: ObjectId,
+        *,
+        limit: int = 0,
+    ) -> List[Dict[str, Any]]:
+        cursor = self.user_collection.find(
+            {"barriers": barrier_id},
+            {"username": 1, "first_name": 1, "last_name": 1, "role": 1},
+        ).limit(limit)
+        return await cursor.to_list(length=None)
+
+    async def count_users_for_barrier(
+        self,
+        barrier_id: ObjectId,
+    ) -> int:
+        return await self.user_collection.count_documents({"barriers": barrier_id})
+
+    async def acquire_barrier_open_lease(
+        self,
+        barrier_id: ObjectId,
+        *,
+        owner: str,
+        ttl: float,
+    ) -> bool:
+        """Returns True if `owner` should call the barrier, False if another worker holds the lease"""
+        now = datetime.utcnow()
+        try:
+            await self.barrier_open_lease_collection.update_one(
+                {"_id": barrier_id, "expires_at": {"$lt": now}},
+                {
+                    "$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl)},
+                    "$unset": {"result": "", "error": ""},
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def set_barrier_open_result(
+        self,
+        barrier_id: ObjectId,
+        *,
+        owner: str,
+        window: float,
+        result: Optional[str] = None,
+        error: Optional[str] = None,
+    ):
+        """Shares the result of a call with the other workers for `window` seconds"""
+        now = datetime.utcnow()
+        update = {
+            "result": result,
+            "error": error,
+            # failed calls are not shared with requests arriving later
+            "expires_at": now if error is not None else now + timedelta(seconds=window),
+        }
+        await self.barrier_open_lease_collection.update_one(
+            {"_id": barrier_id, "owner": owner},
+            {"$set": update},
+        )
+
+    async def add_pending_call(
+        self,
+        phone_number: str,
+        *,
+        chat_id: ChatId,
+        message_id: MessageId,
+        barrier_name: str,
+        created_at: datetime,
+        ttl: float,
+    ) -> ObjectId:
+        """
+        Remembers the message to edit once Zadarma reports how the call to `phone_number` ended
+        :param created_at: when the barrier was asked to open, in UTC
+        :return: id of the pending call for `pop_pending_call`
+        """
+        result = await self.pending_call_collection.insert_one({
+            "phone_number": phone_number,
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "barrier_name": barrier_name,
+            "created_at": created_at,
+            "expires_at": datetime.utcnow() + timedelta(seconds=ttl),
+        })
+        return result.inserted_id
+
+    async def pop_pending_call(
+        self,
+        pending_call_id: ObjectId,
+    ) -> Optional[Dict[str, Any]]:
+        """Returns and forgets the pending call unless a notification took it already"""
+        return await self.pending_call_collection.find_one_and_delete({"_id": pending_call_id})
+
+    async def pop_pending_calls(
+        self,
+        phone_number: str,
+        *,
+        created_before: datetime,
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns and forgets messages waiting for the call to `phone_number`, kept in mongo for any worker.
+        Only messages created before `created_before` are taken, later ones wait for the next call.
+        Every message is taken by a single worker, even if several handle the same notification
+        """
+        query = {
+            "phone_number": phone_number,
+            "created_at": {"$lt": created_before},
+            "expires_at": {"$gt": datetime.utcnow()},
+        }
+        pending_calls = []
+        while True:
+            pending_call = await self.pending_call_collection.find_one_and_delete(query)
+            if pending_call is None:
+                return pending_calls
+            pending_calls.append(pending_call)
+
+    async def get_barrier_open_lease(
+        self,
+        barrier_id: ObjectId,
+    ) -> Optional[Dict[str, Any]]:
+        return await self.barrier_open_lease_collection.find_one({"_id": barrier_id})
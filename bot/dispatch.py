@@ -0,0 +1,120 @@
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from bot.errors import ZadarmaUnavailableError
+
+
+logger = logging.getLogger(__name__)
+
+
+class MongoOpenLease:
+    """
+    Lease in mongo letting exactly one of several workers call a barrier
+    within `window` seconds, the others wait for its result. The lease is
+    taken for `ttl` seconds, the longest a call might take, so it doesn't
+    expire while the call is in progress, and is kept for `window` seconds
+    after a successful call
+    """
+
+    def __init__(
+        self,
+        db,
+        ttl: float,
+        window: float,
+        wait_timeout: float,
+        poll_interval: float = 0.2,
+    ):
+        self.db = db
+        self.ttl = ttl
+        self.window = window
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def acquire(self, barrier_id: Hashable) -> bool:
+        return await self.db.acquire_barrier_open_lease(barrier_id, owner=self.owner, ttl=self.ttl)
+
+    async def release(
+        self,
+        barrier_id: Hashable,
+        result: Optional[str] = None,
+        error: Optional[Exception] = None,
+    ) -> None:
+        await self.db.set_barrier_open_result(
+            barrier_id,
+            owner=self.owner,
+            window=self.window,
+            result=result,
+            error=str(error) if error is not None else None,
+        )
+
+    async def wait(self, barrier_id: Hashable) -> str:
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            lease = await self.db.get_barrier_open_lease(barrier_id)
+            if lease is not None and "result" in lease:
+                if lease.get("error") is not None:
+                    raise ZadarmaUnavailableError(f"Call by another worker failed: {lease['error']}")
+                return lease["result"]
+            await asyncio.sleep(self.poll_interval)
+        raise ZadarmaUnavailableError(f"Timed out waiting for another worker to call barrier {barrier_id}")
+
+
+class OpenDispatcher:
+    """
+    Collapses open requests for the same barrier arriving within `window` seconds
+    into a single outgoing call and fans its result out to every waiting request.
+    With `lease`, requests are collapsed across workers too.
+    """
+
+    def __init__(
+        self,
+        call: Callable[[str], Awaitable[str]],
+        window: float,
+        lease: Optional[MongoOpenLease] = None,
+    ):
+        self.call = call
+        self.window = window
+        self.lease = lease
+        self._pending: Dict[Hashable, Tuple[float, "asyncio.Future[str]"]] = {}
+
+    async def open(self, barrier_id: Hashable, phone_number: str) -> str:
+        pending = self._pending.get(barrier_id)
+        if pending is not None and time.monotonic() - pending[0] < self.window:
+            logger.info(f"Joining pending call for barrier {barrier_id}")
+            return await asyncio.shield(pending[1])
+
+        task = asyncio.ensure_future(self._dispatch(barrier_id, phone_number))
+        self._pending[barrier_id] = (time.monotonic(), task)
+        task.add_done_callback(lambda _: self._on_done(barrier_id, task))
+        return await asyncio.shield(task)
+
+    async def _dispatch(self, barrier_id: Hashable, phone_number: str) -> str:
+        if self.lease is None:
+            return await self.call(phone_number)
+        if not await self.lease.acquire(barrier_id):
+            logger.info(f"Waiting for another worker calling barrier {barrier_id}")
+            return await self.lease.wait(barrier_id)
+        try:
+            result = await self.call(phone_number)
+        except Exception as e:
+            await self.lease.release(barrier_id, error=e)
+            raise
+        await self.lease.release(barrier_id, result=result)
+        return result
+
+    def _on_done(self, barrier_id: Hashable, task: "asyncio.Future[str]") -> None:
+        if task.cancelled() or task.exception() is not None:
+            # failed calls are not shared with requests arriving later
+            self._forget(barrier_id, task)
+        else:
+            asyncio.get_running_loop().call_later(self.window, self._forget, barrier_id, task)
+
+    def _forget(self, barrier_id: Hashable, task: "asyncio.Future[str]") -> None:
+        pending = self._pending.get(barrier_id)
+        if pending is not None and pending[1] is task:
+            del self._pending[barrier_id]
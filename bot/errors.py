@@ -1,5 +1,4 @@
 from typing import Optional
-from llm_tools.tokens import TokenExpenses
 
 class APIOverloadedError(TimeoutError):
     pass
@@ -18,3 +17,6 @@ class FileIsTooBigError(ValueError):
 
 class LanguageDetectionError(ValueError):
     pass
+
+class ZadarmaUnavailableError(ConnectionError):
+    pass
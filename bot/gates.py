@@ -1,12 +1,23 @@
-from bot.zadarma.api import ZadarmaAPI
-from bot.config import zadarma_api_key, zadarma_api_secret, zadarma_number, zadarma_sip
+import json
 
+from bot import config
+from bot.services import services
 
-z_api = ZadarmaAPI(key=zadarma_api_key, secret=zadarma_api_secret)
 
-
-def call_number(to_number):
-    return z_api.call(
+async def call_number(to_number):
+    return await services.z_governor.call(
         "/v1/request/callback/",
-        {"from": zadarma_number, "to": to_number, "sip": zadarma_sip, "predicted": "1"},
+        {"from": config.zadarma_number, "to": to_number, "sip": config.zadarma_sip, "predicted": "1"},
     )
+
+
+async def open_barrier(barrier):
+    return await services.open_dispatcher.open(barrier["_id"], barrier["phone_number"])
+
+
+def get_call_status(response: str) -> str:
+    """Status reported by Zadarma in the response of `call_number`"""
+    try:
+        return str(json.loads(response).get("status", "unknown"))
+    except (ValueError, AttributeError):
+        return "unknown"
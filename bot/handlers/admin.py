@@ -1,25 +1,56 @@
 import logging
-from typing import Optional
+import html
+import tempfile
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple
+from collections import Counter
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
-from telegram.constants import ParseMode
+from telegram.constants import ParseMode, MessageLimit
+from bson.objectid import ObjectId
 
 from bot.handlers.utils import (
     add_handler_routines,
     send_reply,
+    split_text_at_good_places,
+    clamp_page,
+    make_page_buttons,
+    BARRIERS_PAGE_SIZE,
 )
-from bot.database import db
+from bot.services import services
 from bot.handlers import manage_data as md
+from bot import transfer
 
 
 logger = logging.getLogger(__name__)
 
+BARRIER_USERS_LIMIT = 100
+HISTORY_PAGE_SIZE = 20
+STATS_DEFAULT_DAYS = 7
+STATS_MAX_DAYS = 90
+STATS_TOP_SIZE = 5
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_barrier_id_by_number(barrier_ids: List[ObjectId], number: str) -> Optional[ObjectId]:
+    """
+    Barriers are numbered by position in the list of the user, like in /open,
+    so numbers don't shift when some barrier is deleted
+    """
+    if not number.isdigit() or not 1 <= int(number) <= len(barrier_ids):
+        return None
+    return barrier_ids[int(number) - 1]
+
 
 def make_user_keyboard(
     contact_user_id: int,
     current_role: Optional[md.Role] = None,
 ) -> InlineKeyboardMarkup:
+    key = ("user", contact_user_id, current_role)
+    keyboard = services.keyboard_cache.get(key)
+    if keyboard is not None:
+        return keyboard
     role_to_text = {
         md.Role.ADMIN: "Администратор",
         md.Role.USER: "Пользователь",
@@ -35,28 +66,59 @@ def make_user_keyboard(
             callback_data=md.ChooseRoleData(role=role, user_id=contact_user_id).dump(),
         )
         buttons.append(button)
-    return InlineKeyboardMarkup.from_column(buttons)
+    keyboard = InlineKeyboardMarkup.from_column(buttons)
+    services.keyboard_cache.set(key, keyboard)
+    return keyboard
 
 
-def make_user_access_barriers_keyboard(
+async def make_user_access_barriers_keyboard(
     contact_user_id: int,
     admin_user_id: int, 
+    accessible_barriers: Optional[List[ObjectId]] = None,
+    page: int = 0,
 ) -> InlineKeyboardMarkup:
+    """Only barriers of `page` are fetched and shown, with buttons to the neighbouring pages"""
     buttons = []
-    db.add_or_update_user(contact_user_id)
-    all_barriers = db.get_user_attribute(admin_user_id, "barriers", default=[])
-    accessible_barriers = db.get_user_attribute(contact_user_id, "barriers", default=[])
-    for i, barrier_id in enumerate(all_barriers, start=1):
-        barrier = db.get_barrier(barrier_id)
+    all_barriers = await services.db.get_user_attribute(admin_user_id, "barriers", default=[])
+    if accessible_barriers is None:
+        accessible_barriers = await services.db.get_user_attribute(contact_user_id, "barriers", default=[])
+    page = clamp_page(page, len(all_barriers))
+    page_barrier_ids = all_barriers[page * BARRIERS_PAGE_SIZE:(page + 1) * BARRIERS_PAGE_SIZE]
+    key = (
+        "access",
+        contact_user_id,
+        tuple(page_barrier_ids),
+        page,
+        len(all_barriers),
+        frozenset(accessible_barriers).intersection(page_barrier_ids),
+        services.db.barriers_version,
+    )
+    keyboard = services.keyboard_cache.get(key)
+    if keyboard is not None:
+        return keyboard
+    barriers = {x["_id"]: x for x in await services.db.get_barriers_by_ids(page_barrier_ids)}
+    for i, barrier_id in enumerate(page_barrier_ids, start=page * BARRIERS_PAGE_SIZE + 1):
+        barrier = barriers.get(barrier_id)
+        if barrier is None:
+            continue
         name = barrier["name"].replace("_", " ")
         button_text = f"{i}. {name}\n"
         if barrier_id in accessible_barriers:
             button_text = f"✅ {button_text}"
-        buttons.append(InlineKeyboardButton(
+        buttons.append([InlineKeyboardButton(
             text=button_text,
             callback_data=md.BarrierAccessData(barrier_id=barrier["_id"], user_id=contact_user_id).dump(),
-        ))
-    return InlineKeyboardMarkup.from_column(buttons)
+        )])
+    page_buttons = make_page_buttons(
+        page,
+        len(all_barriers),
+        lambda x: md.BarrierAccessPageData(user_id=contact_user_id, page=x),
+    )
+    if page_buttons:
+        buttons.append(page_buttons)
+    keyboard = InlineKeyboardMarkup(buttons)
+    services.keyboard_cache.set(key, keyboard)
+    return keyboard
 
 
 @add_handler_routines(
@@ -66,6 +128,7 @@ async def user_contact_handler(update: Update, context: CallbackContext) -> None
     contact = update.message.contact
     contact_user_id = contact.user_id
     name = f"{contact.first_name} {contact.last_name}"
+    await services.db.add_or_update_user(contact_user_id)
     await send_reply(
         message=update.effective_message,
         text=f"Выберите роль для пользователя {name}:",
@@ -75,7 +138,7 @@ async def user_contact_handler(update: Update, context: CallbackContext) -> None
     await send_reply(
          message=update.effective_message,
         text=f"Выберите к каким шлагбаумам дать доступ пользователю {name}:",
-        reply_markup=make_user_access_barriers_keyboard(
+        reply_markup=await make_user_access_barriers_keyboard(
             contact_user_id=contact_user_id,
             admin_user_id=update.effective_user.id
         ),
@@ -91,7 +154,7 @@ async def choose_role_handler(update: Update, context: CallbackContext) -> None:
     data = md.ChooseRoleData.load(update.callback_query.data)
     user_id = data.user_id
     role = data.role
-    db.add_or_update_user(user_id, role=role.value)
+    await services.db.add_or_update_user(user_id, role=role.value)
     await send_reply(
         message=update.effective_message,
         text=update.effective_message.text,
@@ -106,13 +169,385 @@ async def choose_role_handler(update: Update, context: CallbackContext) -> None:
 )
 async def give_access_handler(update: Update, context: CallbackContext) -> None:
     data = md.BarrierAccessData.load(update.callback_query.data)
-    db.switch_barrier_access_for_user(
+    accessible_barriers = await services.db.switch_barrier_access_for_user(
         barrier_id=data.barrier_id,
         user_id=data.user_id,
     )
+    # stay on the page of the toggled barrier
+    all_barriers = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    page = all_barriers.index(data.barrier_id) // BARRIERS_PAGE_SIZE if data.barrier_id in all_barriers else 0
+    await send_reply(
+        message=update.effective_message,
+        text=update.effective_message.text,
+        reply_markup=await make_user_access_barriers_keyboard(
+            data.user_id,
+            update.effective_user.id,
+            accessible_barriers=accessible_barriers,
+            page=page,
+        ),
+        try_edit=True,
+    )
+
+
+@add_handler_routines(
+    check_is_admin=True,
+    answer_callback_query=True,
+)
+async def barrier_access_page_handler(update: Update, context: CallbackContext) -> None:
+    data = md.BarrierAccessPageData.load(update.callback_query.data)
     await send_reply(
         message=update.effective_message,
         text=update.effective_message.text,
-        reply_markup=make_user_access_barriers_keyboard(data.user_id, update.effective_user.id),
+        reply_markup=await make_user_access_barriers_keyboard(
+            data.user_id,
+            update.effective_user.id,
+            page=data.page,
+        ),
+        try_edit=True,
+    )
+
+
+async def get_barrier_from_args(update: Update, context: CallbackContext) -> Optional[Dict[str, Any]]:
+    """Barrier of /open number given as the only argument of a command"""
+    if len(context.args) != 1:
+        return None
+    barrier_ids = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    barrier_id = get_barrier_id_by_number(barrier_ids, context.args[0])
+    return await services.db.get_barrier(barrier_id) if barrier_id is not None else None
+
+
+@add_handler_routines(
+    check_is_admin=True,
+)
+async def barrier_users_handler(update: Update, context: CallbackContext) -> None:
+    barrier = await get_barrier_from_args(update, context)
+    if barrier is None:
+        await send_reply(
+            message=update.effective_message,
+            text=(
+                "Отправьте команду в формате \n\n"
+                "`/barrier_users <номер шлагбаума из /open>`"
+            ),
+            send_as_reply=True,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+    users = await services.db.get_users_for_barrier(barrier["_id"], limit=BARRIER_USERS_LIMIT)
+    n_users = await services.db.count_users_for_barrier(barrier["_id"])
+    name = html.escape(barrier["name"].replace("_", " "))
+    lines = [f"Доступ к шлагбауму <b>{name}</b> есть у {n_users} пользователей:\n"]
+    for i, user in enumerate(users, start=1):
+        user_name = " ".join(x for x in (user.get("first_name"), user.get("last_name")) if x)
+        line = f"{i}. {html.escape(user_name)}"
+        if user.get("username"):
+            line += f" (@{user['username']})"
+        line += f" — {user.get('role', md.Role.BANNED.value)}"
+        lines.append(line)
+    if n_users > len(users):
+        lines.append(f"... и ещё {n_users - len(users)}")
+    for text_chunk in split_text_at_good_places("\n".join(lines), MessageLimit.MAX_TEXT_LENGTH):
+        await send_reply(
+            message=update.effective_message,
+            text=text_chunk,
+            parse_mode=ParseMode.HTML,
+        )
+
+
+def format_user_name(user_id: int, user: Optional[Dict[str, Any]]) -> str:
+    user = user or {}
+    if user.get("username"):
+        return f"@{user['username']}"
+    return html.escape(user.get("first_name") or str(user_id))
+
+
+async def make_history_page(
+    barrier: Dict[str, Any],
+    before: Optional[datetime] = None,
+    before_id: Optional[ObjectId] = None,
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    events = await services.db.get_barrier_events(
+        barrier["_id"],
+        before=before,
+        before_id=before_id,
+        limit=HISTORY_PAGE_SIZE,
+    )
+    name = html.escape(barrier["name"].replace("_", " "))
+    if not events:
+        text = f"Шлагбаум <b>{name}</b> ещё не открывали" if before is None else f"Более ранних открытий <b>{name}</b> нет"
+        return text, None
+
+    users = {x: await services.db.get_user(x) for x in dict.fromkeys(x["user_id"] for x in events)}
+    lines = [f"Открытия шлагбаума <b>{name}</b> (время UTC):\n"]
+    for event in events:
+        user_name = format_user_name(event["user_id"], users[event["user_id"]])
+        lines.append(
+            f"{event['timestamp']:%d.%m %H:%M:%S} — {user_name} — "
+            f"{html.escape(event['status'])}, {event['latency']:.1f} с"
+        )
+    keyboard = None
+    if len(events) == HISTORY_PAGE_SIZE:
+        before_ms = (events[-1]["timestamp"] - EPOCH) // timedelta(milliseconds=1)
+        keyboard = InlineKeyboardMarkup.from_button(InlineKeyboardButton(
+            text="⬅️ Ранее",
+            callback_data=md.HistoryData(
+                barrier_id=barrier["_id"],
+                before=before_ms,
+                before_id=events[-1]["_id"],
+            ).dump(),
+        ))
+    return "\n".join(lines), keyboard
+
+
+@add_handler_routines(
+    check_is_admin=True,
+)
+async def history_handler(update: Update, context: CallbackContext) -> None:
+    barrier = await get_barrier_from_args(update, context)
+    if barrier is None:
+        await send_reply(
+            message=update.effective_message,
+            text=(
+                "Отправьте команду в формате \n\n"
+                "`/history <номер шлагбаума из /open>`"
+            ),
+            send_as_reply=True,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+    text, keyboard = await make_history_page(barrier)
+    await send_reply(
+        message=update.effective_message,
+        text=text,
+        reply_markup=keyboard,
+        parse_mode=ParseMode.HTML,
+    )
+
+
+@add_handler_routines(
+    check_is_admin=True,
+    answer_callback_query=True,
+)
+async def history_page_handler(update: Update, context: CallbackContext) -> None:
+    data = md.HistoryData.load(update.callback_query.data)
+    barrier_ids = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    barrier = await services.db.get_barrier(data.barrier_id)
+    if barrier is None or barrier["_id"] not in barrier_ids:
+        await send_reply(update.effective_message, text="Нет доступа к шлагбауму!")
+        return
+    text, keyboard = await make_history_page(
+        barrier,
+        before=EPOCH + timedelta(milliseconds=data.before),
+        before_id=data.before_id,
+    )
+    await send_reply(
+        message=update.effective_message,
+        text=text,
+        reply_markup=keyboard,
+        parse_mode=ParseMode.HTML,
         try_edit=True,
     )
+
+
+@add_handler_routines(
+    check_is_admin=True,
+)
+async def stats_handler(update: Update, context: CallbackContext) -> None:
+    if len(context.args) > 1 or (context.args and not (
+        context.args[0].isdigit() and 1 <= int(context.args[0]) <= STATS_MAX_DAYS
+    )):
+        await send_reply(
+            message=update.effective_message,
+            text=(
+                "Отправьте команду в формате \n\n"
+                f"`/stats <число дней, до {STATS_MAX_DAYS}>`"
+            ),
+            send_as_reply=True,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+    n_days = int(context.args[0]) if context.args else STATS_DEFAULT_DAYS
+    barrier_ids = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    # at most one rollup per barrier and day, whatever the number of opens
+    rollups = await services.db.get_usage(barrier_ids, since=today - timedelta(days=n_days - 1))
+
+    barrier_counts, hour_counts, user_counts = Counter(), Counter(), Counter()
+    n_failed = 0
+    for rollup in rollups:
+        barrier_counts[rollup["barrier_id"]] += rollup.get("count", 0)
+        hour_counts.update({int(k): v for k, v in rollup.get("hours", {}).items()})
+        user_counts.update({int(k): v for k, v in rollup.get("users", {}).items()})
+        n_failed += rollup.get("failed", 0)
+    if not barrier_counts:
+        await send_reply(
+            message=update.effective_message,
+            text=f"За последние {n_days} дн. шлагбаумы не открывали",
+        )
+        return
+
+    barriers = {x["_id"]: x for x in await services.db.get_barriers_by_ids(list(barrier_counts))}
+    lines = [
+        f"<b>Статистика за {n_days} дн.</b> (время UTC)\n",
+        f"Всего открытий: {sum(barrier_counts.values())}, из них с ошибкой: {n_failed}\n",
+        "<b>Шлагбаумы:</b>",
+    ]
+    for barrier_id, count in barrier_counts.most_common(STATS_TOP_SIZE):
+        name = barriers[barrier_id]["name"].replace("_", " ") if barrier_id in barriers else str(barrier_id)
+        lines.append(f"{html.escape(name)} — {count}")
+    lines.append("\n<b>Часы:</b>")
+    for hour, count in hour_counts.most_common(STATS_TOP_SIZE):
+        lines.append(f"{hour:02d}:00–{hour:02d}:59 — {count}")
+    lines.append("\n<b>Пользователи:</b>")
+    for user_id, count in user_counts.most_common(STATS_TOP_SIZE):
+        lines.append(f"{format_user_name(user_id, await services.db.get_user(user_id))} — {count}")
+    await send_reply(
+        message=update.effective_message,
+        text="\n".join(lines),
+        parse_mode=ParseMode.HTML,
+    )
+
+
+async def change_access(update: Update, context: CallbackContext, grant: bool) -> None:
+    command = "grant" if grant else "revoke"
+    barrier_ids = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    reply_to_message = update.effective_message.reply_to_message
+    contact = reply_to_message.contact if reply_to_message is not None else None
+
+    if context.args and context.args[0] == "all":
+        selected_barrier_ids = barrier_ids
+    else:
+        barrier_numbers = context.args[0].split(",") if context.args else []
+        selected_barrier_ids = [get_barrier_id_by_number(barrier_ids, x) for x in dict.fromkeys(barrier_numbers)]
+        if None in selected_barrier_ids:
+            selected_barrier_ids = []
+    selected_barriers = await services.db.get_barriers_by_ids(selected_barrier_ids) if selected_barrier_ids else []
+    if not selected_barriers or (len(context.args) < 2 and contact is None):
+        await send_reply(
+            message=update.effective_message,
+            text=(
+                "Отправьте команду в формате \n\n"
+                f"`/{command} <номера шлагбаумов из /open через запятую или all> <@username или id> ...`\n\n"
+                "Вместо пользователей можно ответить командой на сообщение с контактом."
+            ),
+            send_as_reply=True,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+
+    user_ids = [int(x) for x in context.args[1:] if x.isdigit()]
+    usernames = [x.lstrip("@") for x in context.args[1:] if not x.isdigit()]
+    if contact is not None and contact.user_id is not None:
+        await services.db.add_or_update_user(contact.user_id)
+        user_ids.append(contact.user_id)
+    found_usernames = await services.db.get_user_ids_by_usernames(usernames) if usernames else {}
+    user_ids = list(dict.fromkeys(user_ids + list(found_usernames.values())))
+    changes = await services.db.set_barriers_access(
+        user_ids=user_ids,
+        barrier_ids=[x["_id"] for x in selected_barriers],
+        grant=grant,
+    )
+
+    names = {x["_id"]: html.escape(x["name"].replace("_", " ")) for x in selected_barriers}
+    users = await services.db.get_users_by_ids(user_ids)
+    lines = ["Открыл доступ:" if grant else "Закрыл доступ:"]
+    for user_id, changed_barriers in changes.items():
+        lines.append(f"{format_user_name(user_id, users.get(user_id))}: {', '.join(names[x] for x in changed_barriers)}")
+    if not changes:
+        lines.append("ничего не изменилось")
+    not_found = [f"@{html.escape(x)}" for x in usernames if x not in found_usernames]
+    not_found += [str(x) for x in user_ids if x not in users]
+    if not_found:
+        lines.append(f"\nНе нашёл пользователей: {', '.join(not_found)}")
+    for text_chunk in split_text_at_good_places("\n".join(lines), MessageLimit.MAX_TEXT_LENGTH):
+        await send_reply(
+            message=update.effective_message,
+            text=text_chunk,
+            parse_mode=ParseMode.HTML,
+        )
+
+
+@add_handler_routines(
+    check_is_admin=True,
+)
+async def grant_access_handler(update: Update, context: CallbackContext) -> None:
+    await change_access(update, context, grant=True)
+
+
+@add_handler_routines(
+    check_is_admin=True,
+)
+async def revoke_access_handler(update: Update, context: CallbackContext) -> None:
+    await change_access(update, context, grant=False)
+
+
+@add_handler_routines(
+    check_is_admin=True,
+)
+async def export_handler(update: Update, context: CallbackContext) -> None:
+    if (
+        not 1 <= len(context.args) <= 2 or
+        context.args[0] not in transfer.COLLECTIONS or
+        context.args[1:2] and context.args[1] not in transfer.FORMATS
+    ):
+        await send_reply(
+            message=update.effective_message,
+            text=(
+                "Отправьте команду в формате \n\n"
+                f"`/export <{'|'.join(transfer.COLLECTIONS)}> [{'|'.join(transfer.FORMATS)}]`"
+            ),
+            send_as_reply=True,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+    collection_name = context.args[0]
+    format = context.args[1] if len(context.args) > 1 else "jsonl"
+    # the file is written as the cursor goes, documents are never held in memory
+    with tempfile.TemporaryFile("w+b") as f:
+        async for lines in transfer.iter_export(services.db, collection_name, format):
+            f.write(lines.encode())
+        f.seek(0)
+        await update.effective_message.reply_document(
+            document=f,
+            filename=f"{collection_name}.{format}",
+        )
+
+
+@add_handler_routines(
+    check_is_admin=True,
+)
+async def import_handler(update: Update, context: CallbackContext) -> None:
+    """/import as a caption of a document or a reply to one"""
+    message = update.effective_message
+    args = context.args if context.args is not None else (message.caption or "").split()[1:]
+    document = message.document
+    if document is None and message.reply_to_message is not None:
+        document = message.reply_to_message.document
+    if document is None or len(args) != 1 or args[0] not in transfer.COLLECTIONS:
+        await send_reply(
+            message=message,
+            text=(
+                "Пришлите файл .jsonl или .csv с подписью \n\n"
+                f"`/import <{'|'.join(transfer.COLLECTIONS)}>`\n\n"
+                "или ответьте этой командой на сообщение с файлом"
+            ),
+            send_as_reply=True,
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+    collection_name = args[0]
+    telegram_file = await document.get_file()
+    with tempfile.NamedTemporaryFile() as f:
+        await telegram_file.download_to_drive(f.name)
+        with open(f.name, newline="", encoding="utf-8-sig") as lines:
+            result = await transfer.import_lines(
+                services.db,
+                collection_name,
+                transfer.get_format(document.file_name or ""),
+                lines,
+            )
+    await send_reply(
+        message=message,
+        text=f"<pre>{html.escape(transfer.format_import_result(collection_name, result))}</pre>",
+        parse_mode=ParseMode.HTML,
+        send_as_reply=True,
+    )
@@ -1,21 +1,162 @@
-from typing import Optional, Tuple
+from typing import Optional, Dict, List, Tuple
+from dataclasses import dataclass, field
+from datetime import datetime
 import logging
 import traceback
+import hashlib
 import html
 import json
-import uuid
 
 from telegram import Update, Bot
 from telegram.constants import ParseMode, MessageLimit
 
 from bot import config
-from bot.database import db, ChatId, UserId
+from bot.database import ChatId, UserId
 from bot.handlers.utils import split_text_at_good_places
 from bot.handlers.utils import send_reply
 
 
 logger = logging.getLogger(__name__)
 
+# limits keeping an error storm from growing memory and the summary
+MAX_FINGERPRINTS = 20
+MAX_SAMPLES = 5
+MAX_UPDATE_LENGTH = 2000
+
+
+@dataclass
+class ErrorReport:
+    fingerprint: str
+    error_type: str
+    # details of the first occurrence, the rest only add to counters and samples
+    traceback_str: str
+    update_str: str
+    chat_id: Optional[ChatId]
+    user_id: Optional[UserId]
+    first_seen: datetime
+    last_seen: datetime
+    count: int = 0
+    update_ids: List[int] = field(default_factory=list)
+    usernames: List[str] = field(default_factory=list)
+
+
+def get_error_fingerprint(error: Exception) -> str:
+    """Hash of exception type and the bot's own frames, so the same failure matches regardless of its message"""
+    frames = traceback.extract_tb(error.__traceback__)
+    own_frames = [x for x in frames if x.filename.startswith(str(config.bot_dir))] or frames[-1:]
+    key = "\n".join(
+        [f"{type(error).__module__}.{type(error).__qualname__}"]
+        + [f"{x.filename}:{x.name}:{x.lineno}" for x in own_frames]
+    )
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def format_traceback(error: Exception) -> str:
+    traceback_list = traceback.format_exception(None, error, error.__traceback__)
+    filtered_traceback_list = []
+    system_files_started = False
+    system_files_finished = False
+    for x in traceback_list:
+        is_system_line = 'File "/usr/local/lib' in x
+        if is_system_line:
+            system_files_started = True
+        if system_files_finished or not is_system_line:
+            filtered_traceback_list.append(x)
+        if system_files_started and not is_system_line:
+            system_files_finished = True
+    return "".join(filtered_traceback_list)
+
+
+def format_update(update: Optional[object]) -> str:
+    if update is None:
+        return ""
+    if not isinstance(update, Update):
+        return str(update)[:MAX_UPDATE_LENGTH]
+    update_dict = update.to_dict()
+    try:
+        if "message" in update_dict:
+            update_dict["message"]["text"] = update_dict["message"]["text"][:50] + "..."
+    except:
+        pass
+    return json.dumps(update_dict, indent=2, ensure_ascii=False)[:MAX_UPDATE_LENGTH]
+
+
+class ErrorAggregator:
+    """
+    Collects errors between flushes grouped by fingerprint, so a storm of
+    identical exceptions becomes a single summary. Only the first occurrence
+    of every fingerprint is formatted, and at most `max_fingerprints` are kept,
+    errors beyond that are only counted
+    """
+
+    def __init__(self, max_fingerprints: int = MAX_FINGERPRINTS, max_samples: int = MAX_SAMPLES):
+        self.max_fingerprints = max_fingerprints
+        self.max_samples = max_samples
+        self.reports: Dict[str, ErrorReport] = {}
+        self.n_dropped = 0
+
+    def add(
+        self,
+        error: Exception,
+        update: Optional[object] = None,
+        chat_id: Optional[ChatId] = None,
+        user_id: Optional[UserId] = None,
+        username: Optional[str] = None,
+    ) -> None:
+        fingerprint = get_error_fingerprint(error)
+        report = self.reports.get(fingerprint)
+        now = datetime.now()
+        if report is None:
+            if len(self.reports) >= self.max_fingerprints:
+                self.n_dropped += 1
+                return
+            report = self.reports[fingerprint] = ErrorReport(
+                fingerprint=fingerprint,
+                error_type=type(error).__qualname__,
+                traceback_str=format_traceback(error),
+                update_str=format_update(update),
+                chat_id=chat_id,
+                user_id=user_id,
+                first_seen=now,
+                last_seen=now,
+            )
+        report.count += 1
+        report.last_seen = now
+        update_id = getattr(update, "update_id", None)
+        if update_id is not None and len(report.update_ids) < self.max_samples:
+            report.update_ids.append(update_id)
+        if username and username not in report.usernames and len(report.usernames) < self.max_samples:
+            report.usernames.append(username)
+
+    def pop(self) -> Tuple[List[ErrorReport], int]:
+        """Returns collected reports and the number of dropped errors, starting a new window"""
+        reports, n_dropped = list(self.reports.values()), self.n_dropped
+        self.reports, self.n_dropped = {}, 0
+        return reports, n_dropped
+
+
+error_reports = ErrorAggregator()
+
+
+def format_error_report(report: ErrorReport) -> str:
+    text = (
+        f"<b>🚨 {html.escape(report.error_type)} × {report.count}</b>\n"
+        f"  ⤷ fingerprint: <code>{report.fingerprint}</code>\n"
+        f"  ⤷ seen: {report.first_seen:%H:%M:%S} – {report.last_seen:%H:%M:%S}\n"
+        f"  ⤷ chat_id: <code>{report.chat_id}</code>\n"
+        f"  ⤷ user_id: <code>{report.user_id}</code>\n"
+    )
+    if report.update_ids:
+        text += f"  ⤷ update ids: {', '.join(f'<code>{x}</code>' for x in report.update_ids)}\n"
+    if report.usernames:
+        text += f"  ⤷ users: {', '.join(f'@{x}' for x in report.usernames)}\n"
+    text += "\n"
+    if report.update_str:
+        text += f"<b>🔄 Update:</b>\n<pre>update = {html.escape(report.update_str)}</pre>\n\n"
+    if report.traceback_str:
+        text += f"<b>🔴 Traceback:</b>\n<pre>{html.escape(report.traceback_str)}</pre>\n\n"
+    return text
+
 
 async def send_error_message_to_admin_chat(
     error: Exception,
@@ -25,9 +166,24 @@ async def send_error_message_to_admin_chat(
     user_id: Optional[UserId] = None,
     update: Optional[Update] = None,
 ) -> None:
-    error_id = str(uuid.uuid4())
+    """Queues the error for the next summary sent by `flush_error_reports`"""
+    if config.admin_chat_id is None:
+        return
+    try:
+        error_reports.add(error, update=update, chat_id=chat_id, user_id=user_id, username=username)
+    except Exception:
+        logger.exception("Could not add error to the admin chat report")
 
-    async def _send_text(text: str):
+
+async def flush_error_reports(bot: Bot) -> None:
+    reports, n_dropped = error_reports.pop()
+    if not reports:
+        return
+
+    text = "".join(format_error_report(x) for x in reports)
+    if n_dropped:
+        text += f"<b>➕ {n_dropped} more errors of other kinds</b>\n"
+    try:
         for text_chunk in split_text_at_good_places(text, MessageLimit.MAX_TEXT_LENGTH):
             await send_reply(
                 bot=bot,
@@ -36,59 +192,5 @@ async def send_error_message_to_admin_chat(
                 parse_mode=ParseMode.HTML,
                 try_no_parse_mode=True
             )
-
-    try:
-        if config.admin_chat_id is not None:
-            # update str
-            if update is not None:
-                if isinstance(update, Update):
-                    update_str = update.to_dict()
-                    try:
-                        if "message" in update_str:
-                            update_str["message"]["text"] = update_str["message"]["text"][:50] + "..."
-                    except:
-                        pass
-                else:
-                    update_str = str(update)
-            else:
-                update_str = ""
-
-            # traceback str
-            traceback_list = traceback.format_exception(None, error, error.__traceback__)
-            filtered_traceback_list = []
-            system_files_started = False
-            system_files_finished = False
-            for x in traceback_list:
-                is_system_line = 'File "/usr/local/lib' in x
-                if is_system_line:
-                    system_files_started = True
-                if system_files_finished or not is_system_line:
-                    filtered_traceback_list.append(x)
-                if system_files_started and not is_system_line:
-                    system_files_finished = True
-            traceback_str = "".join(filtered_traceback_list)
-
-            text = (
-                f"<b>🚨 Exception was raised:</b>\n"
-                f"  ⤷ error_id: <code>{error_id}</code>\n"
-                f"  ⤷ chat_id: <code>{chat_id}</code>\n"
-                f"  ⤷ user_id: <code>{user_id}</code>\n"
-                f"  ⤷ username: @{username}\n\n"
-            )
-            await _send_text(text)
-
-            if update_str:
-                text = (
-                    f"<b>🔄 Update:</b>\n"
-                    f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}</pre>\n\n"
-                )
-                await _send_text(text)
-
-            if traceback_str:
-                text = (
-                    f"<b>🔴 Traceback:</b>\n"
-                    f"<pre>{html.escape(traceback_str)}</pre>"
-                )
-                await _send_text(text)
-    except Exception as e:
+    except Exception:
         logger.error("Could not send error message to admin chat")
@@ -8,7 +8,6 @@ from telegram.constants import ParseMode
 from bot.handlers.utils import (
     add_handler_routines,
 )
-from bot.database import db
 from bot.handlers import manage_data as md
 from bot import config
 
@@ -41,9 +40,16 @@ async def help_handle(update: Update, context: CallbackContext):
         f"Привет 👋 Я бот для открывания шлагбаумов от @{config.support_username}.\n"
         f"Чтобы открыть шлагбаум, <b>нажми команду</b> /open.\n\n"
         f"<b>Для админов:</b>\nЧтобы добавить нового пользователя, пришли мне его <b>контакт</b>.\n"
+        f"Чтобы открыть доступ сразу нескольким пользователям, напиши "
+        f"<code>/grant 1,2 @username 123456</code>, где 1,2 — номера шлагбаумов из /open, "
+        f"закрыть — <code>/revoke</code> в том же формате.\n"
         f"Для добавления нового шлагбаума, напиши \n\n"
         f"<code>/add_barrier +7XXXXXXXXXX 'название шлагбаума'</code>.\n\n"
         f"Убедись, что номер {config.zadarma_number} привязан к шлагбауму.\n\n"
+        f"Чтобы посмотреть, у кого есть доступ к шлагбауму, напиши "
+        f"<code>/barrier_users N</code>, где N — номер шлагбаума из /open.\n"
+        f"История открытий шлагбаума: <code>/history N</code>, "
+        f"статистика за последние дни: <code>/stats</code>.\n\n"
         f"Для удаления шлагбаума обратись к @{config.support_username} 🙂"
     )
     await update.message.reply_text(
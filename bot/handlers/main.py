@@ -1,6 +1,10 @@
 import logging
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from bson.objectid import ObjectId
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
 from telegram.constants import ParseMode
 from telegram.ext import CallbackContext
 
@@ -8,14 +12,23 @@ import bot.handlers.manage_data as md
 from bot.handlers.utils import (
     send_reply,
     add_handler_routines,
+    clamp_page,
+    make_page_buttons,
+    BARRIERS_PAGE_SIZE,
 )
-from bot.database import db
-from bot.gates import call_number
+from bot.services import services
+from bot.gates import open_barrier, get_call_status
+from bot.validation import is_valid_phone_number, normalize_phone_number
+from bot.errors import ZadarmaUnavailableError
 from bot import config
 
 
 logger = logging.getLogger(__name__)
 
+# the GSM module of a barrier opens on an incoming call from a known number and
+# usually drops it, so every disposition where the call rang means success
+REACHED_DISPOSITIONS = {"answered", "busy", "cancel", "no answer"}
+
 
 
 @add_handler_routines(
@@ -42,11 +55,7 @@ async def add_barrier_handler(update: Update, context: CallbackContext) -> None:
             send_as_reply=True,
         )
         return
-    if (
-        not phone_number.startswith("+7") or
-        not all(x.isdigit() for x in phone_number[1:]) or
-        len(phone_number) != 12
-    ):
+    if not is_valid_phone_number(phone_number):
         await send_reply(
             message=update.effective_message,
             text=f"Неверный формат номера `{phone_number}`!",
@@ -54,8 +63,8 @@ async def add_barrier_handler(update: Update, context: CallbackContext) -> None:
         )
         return
     barrier_name = "_".join(barrier_name)
-    barrier_id = db.add_barrier(phone_number=phone_number, name=barrier_name)
-    db.add_barrier_to_user(
+    barrier_id = await services.db.add_barrier(phone_number=phone_number, name=barrier_name)
+    await services.db.add_barrier_to_user(
         user_id=update.effective_user.id,
         barrier_id=barrier_id,
     )
@@ -69,13 +78,44 @@ async def add_barrier_handler(update: Update, context: CallbackContext) -> None:
     )
 
 
+async def make_barriers_keyboard(
+    barrier_ids: List[ObjectId],
+    page: int = 0,
+) -> InlineKeyboardMarkup:
+    """Only barriers of `page` are fetched and shown, with buttons to the neighbouring pages"""
+    page = clamp_page(page, len(barrier_ids))
+    page_barrier_ids = barrier_ids[page * BARRIERS_PAGE_SIZE:(page + 1) * BARRIERS_PAGE_SIZE]
+    key = ("barriers", tuple(page_barrier_ids), page, len(barrier_ids), services.db.barriers_version)
+    keyboard = services.keyboard_cache.get(key)
+    if keyboard is not None:
+        return keyboard
+    buttons = []
+    barriers = {x["_id"]: x for x in await services.db.get_barriers_by_ids(page_barrier_ids)}
+    # numbered by position in the list of the user, as /history and others expect
+    for i, barrier_id in enumerate(page_barrier_ids, start=page * BARRIERS_PAGE_SIZE + 1):
+        barrier = barriers.get(barrier_id)
+        if barrier is None:
+            continue
+        name = barrier["name"].replace("_", " ")
+        button_text = f"{i}. {name}\n"
+        buttons.append([InlineKeyboardButton(
+            text=button_text,
+            callback_data=md.BarrierData(barrier["_id"]).dump(),
+        )])
+    page_buttons = make_page_buttons(page, len(barrier_ids), lambda x: md.BarriersPageData(page=x))
+    if page_buttons:
+        buttons.append(page_buttons)
+    keyboard = InlineKeyboardMarkup(buttons)
+    services.keyboard_cache.set(key, keyboard)
+    return keyboard
+
+
 @add_handler_routines(
     check_is_allowed_to_open_barriers=True,
 )
 async def show_barriers_handler(update: Update, context: CallbackContext) -> None:
     text = "Выбери шлагбаум:\n"
-    buttons = []
-    accessible_barriers = db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    accessible_barriers = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
     if len(accessible_barriers) == 0:
         await send_reply(
             message=update.effective_message,
@@ -85,18 +125,25 @@ async def show_barriers_handler(update: Update, context: CallbackContext) -> Non
             )
         )
         return
-    for i, barrier_id in enumerate(accessible_barriers, start=1):
-        barrier = db.get_barrier(barrier_id)
-        name = barrier["name"].replace("_", " ")
-        button_text = f"{i}. {name}\n"
-        buttons.append(InlineKeyboardButton(
-            text=button_text,
-            callback_data=md.BarrierData(barrier["_id"]).dump(),
-        ))
     await send_reply(
         message=update.effective_message,
         text=text,
-        reply_markup=InlineKeyboardMarkup.from_column(buttons),
+        reply_markup=await make_barriers_keyboard(accessible_barriers),
+    )
+
+
+@add_handler_routines(
+    check_is_allowed_to_open_barriers=True,
+    answer_callback_query=True,
+)
+async def barriers_page_handler(update: Update, context: CallbackContext) -> None:
+    data = md.BarriersPageData.load(update.callback_query.data)
+    accessible_barriers = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    await send_reply(
+        message=update.effective_message,
+        text=update.effective_message.text,
+        reply_markup=await make_barriers_keyboard(accessible_barriers, page=data.page),
+        try_edit=True,
     )
 
 
@@ -108,16 +155,109 @@ async def open_barrier_handler(update: Update, context: CallbackContext) -> None
     await update.callback_query.answer(text="Открываю шлагбаум.")
     barrier_id = md.BarrierData.load(update.callback_query.data).barrier_id
     logger.info(barrier_id)
-    barrier = db.get_barrier(barrier_id)
-    accessible_barriers = db.get_user_attribute(update.effective_user.id, "barriers", default=[])
+    barrier = await services.db.get_barrier(barrier_id)
+    accessible_barriers = await services.db.get_user_attribute(update.effective_user.id, "barriers", default=[])
     if barrier["_id"] not in accessible_barriers:
         await send_reply(update.effective_message, text="Нет доступа к шлагбауму!")
     else:
+        requested_at = datetime.utcnow()
+        started_at = time.perf_counter()
+        error = None
         try:
-            text = call_number(barrier["phone_number"])
+            status = get_call_status(await open_barrier(barrier))
+        except ZadarmaUnavailableError as e:
+            status, error = "unavailable", e
         except Exception as e:
-            text = str(e)
+            status, error = "error", e
+        services.db.add_barrier_open_event(
+            user_id=update.effective_user.id,
+            barrier_id=barrier["_id"],
+            latency=time.perf_counter() - started_at,
+            status=status,
+        )
+
+        if isinstance(error, ZadarmaUnavailableError):
+            await send_reply(
+                message=update.effective_message,
+                text=(
+                    "Сервис звонков сейчас недоступен, не получилось открыть шлагбаум. "
+                    f"Попробуйте через минуту или напишите @{config.support_username}"
+                ),
+            )
+        elif error is not None:
             await send_reply(
                 message=update.effective_message,
-                text=f"Позвонил на шлагбаум через API. Ошибка:\n{text}",
+                text=f"Позвонил на шлагбаум через API. Ошибка:\n{error}",
+            )
+        elif config.zadarma_notifications_port:
+            # edited by `report_call_outcome` once Zadarma notifies that the call ended,
+            # or by `call_outcome_timeout_job` if it doesn't in time
+            name = barrier["name"].replace("_", " ")
+            message = await send_reply(
+                message=update.effective_message,
+                text=f"📞 Звоню на шлагбаум {name}…",
             )
+            pending_call_id = await services.db.add_pending_call(
+                normalize_phone_number(barrier["phone_number"]),
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                barrier_name=name,
+                created_at=requested_at,
+                ttl=config.zadarma_call_outcome_timeout,
+            )
+            context.job_queue.run_once(
+                call_outcome_timeout_job,
+                when=config.zadarma_call_outcome_timeout,
+                data=pending_call_id,
+            )
+
+
+async def call_outcome_timeout_job(context: CallbackContext) -> None:
+    """Edits the message waiting for a call if Zadarma hasn't notified how it ended in time"""
+    pending_call = await services.db.pop_pending_call(context.job.data)
+    if pending_call is None:
+        # already reported by `report_call_outcome`
+        return
+    await send_reply(
+        bot=context.bot,
+        chat_id=pending_call["chat_id"],
+        message_id=pending_call["message_id"],
+        text=(
+            f"❔ Не узнал, дозвонился ли до шлагбаума {pending_call['barrier_name']}. "
+            f"Если он не открылся, попробуйте ещё раз или напишите @{config.support_username}"
+        ),
+        try_edit=True,
+    )
+
+
+async def report_call_outcome(
+    bot: Bot,
+    destination: str,
+    disposition: str,
+    call_start: Optional[datetime],
+) -> None:
+    """
+    Edits messages of everyone waiting for the call to `destination`, called by `NotificationReceiver`.
+    Taps within the coalescing window after the call started share it, later ones wait for their own call
+    """
+    created_before = (call_start or datetime.utcnow()) + timedelta(seconds=config.barrier_open_coalesce_window)
+    pending_calls = await services.db.pop_pending_calls(
+        normalize_phone_number(destination),
+        created_before=created_before,
+    )
+    for pending_call in pending_calls:
+        name = pending_call["barrier_name"]
+        if disposition in REACHED_DISPOSITIONS:
+            text = f"✅ Дозвонился до шлагбаума {name}, он должен открыться"
+        else:
+            text = (
+                f"❌ Не дозвонился до шлагбаума {name} ({disposition}). "
+                f"Попробуйте ещё раз или напишите @{config.support_username}"
+            )
+        await send_reply(
+            bot=bot,
+            chat_id=pending_call["chat_id"],
+            message_id=pending_call["message_id"],
+            text=text,
+            try_edit=True,
+        )
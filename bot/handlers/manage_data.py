@@ -1,35 +1,108 @@
-from typing import Optional, Tuple, Any
+from typing import Optional, Tuple, Any, ClassVar, Dict, Type
 
 from enum import Enum
-from dataclasses import dataclass, asdict, fields
+from dataclasses import dataclass, fields
 from bson.objectid import ObjectId
+import base64
+import struct
+
+
+# separator of the old text format `prefix|value|...`, still accepted by `load`
+LEGACY_SEPARATOR = "|"
+
+
+class _Codec:
+    """Packs fields of a `CallbackData` subclass into urlsafe base64, built once per class"""
+
+    def __init__(self, cls: Type["CallbackData"]):
+        self.cls = cls
+        self.names = []
+        self.encoders = []
+        self.decoders = []
+        formats = ["<"]
+        for f in fields(cls):
+            if f.name == "prefix":
+                continue
+            if f.type is ObjectId:
+                formats.append("12s")
+                self.encoders.append(lambda x: x.binary)
+                self.decoders.append(ObjectId)
+            elif isinstance(f.type, type) and issubclass(f.type, Enum):
+                members = list(f.type)
+                formats.append("B")
+                self.encoders.append({x: i for i, x in enumerate(members)}.__getitem__)
+                self.decoders.append(members.__getitem__)
+            elif f.type is bool:
+                formats.append("?")
+                self.encoders.append(bool)
+                self.decoders.append(bool)
+            elif f.type is int:
+                formats.append("q")
+                self.encoders.append(int)
+                self.decoders.append(int)
+            else:
+                raise TypeError(f"Unsupported type {f.type} of field {f.name} in {cls.__name__}")
+            self.names.append(f.name)
+        self.struct = struct.Struct("".join(formats))
+
+    def dump(self, obj: "CallbackData") -> str:
+        values = [encode(getattr(obj, name)) for encode, name in zip(self.encoders, self.names)]
+        payload = base64.urlsafe_b64encode(self.struct.pack(*values)).rstrip(b"=")
+        return obj.prefix + payload.decode("ascii")
+
+    def load(self, data: str) -> "CallbackData":
+        payload = data[1:]
+        payload = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        if len(payload) != self.struct.size:
+            raise ValueError(f"Invalid payload size {len(payload)} in data {data} for {self.cls.__name__}")
+        values = self.struct.unpack(payload)
+        kwargs = {
+            name: decode(value)
+            for name, decode, value in zip(self.names, self.decoders, values)
+        }
+        return self.cls(**kwargs)
 
 
 @dataclass
 class CallbackData:
+    # one-character `prefix` is a type tag routing callbacks, see `get_prefix`.
+    # `legacy_prefix` is set for classes that existed in the old text format
+    legacy_prefix: ClassVar[Optional[str]] = None
+    _codec: ClassVar[Optional[_Codec]] = None
+
+    @classmethod
+    def _get_codec(cls) -> _Codec:
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = _Codec(cls)
+            cls._codec = codec
+        return codec
+
     def dump(self):
-        data = asdict(self)
-        data.pop("prefix")
-        parts = [self.prefix, *data.values()]
-        return "|".join(str(x) for x in parts)
-    
+        return self._get_codec().dump(self)
+
     @classmethod
     def load(cls, data):
-        parts = data.split("|")
-        prefix = parts[0]
+        if LEGACY_SEPARATOR in data:
+            return cls._load_legacy(data)
+        prefix = data[:1]
         if prefix != cls.prefix:
             raise ValueError(f"Invalid prefix: {prefix}")
+        return cls._get_codec().load(data)
+
+    @classmethod
+    def _load_legacy(cls, data):
+        parts = data.split(LEGACY_SEPARATOR)
+        prefix = parts[0]
+        if cls.legacy_prefix is None or prefix != cls.legacy_prefix:
+            raise ValueError(f"Invalid prefix: {prefix}")
         _fields = fields(cls)
         if len(parts) != len(_fields):
             raise ValueError(f"Invalid number of parts {len(parts)} in data {data} for {_fields}")
         _fields = [x for x in _fields if x.name != "prefix"]
         kwargs = {f.name: cls.string_to_field_value(p, f.type) for f, p in zip(_fields, parts[1:])}
         return cls(**kwargs)
-    
-    @classmethod
-    def pattern(cls):
-        return f"^{cls.prefix}"
-    
+
     @staticmethod
     def string_to_field_value(line: str, field_type: type) -> Any:
         if field_type is bool:
@@ -37,6 +110,15 @@ class CallbackData:
         return field_type(line)
 
 
+def get_prefix(data: str) -> str:
+    """Returns type tag of callback data in both current and legacy formats"""
+    if LEGACY_SEPARATOR in data:
+        legacy_prefix = data.split(LEGACY_SEPARATOR, 1)[0]
+        cls = _LEGACY_PREFIX_TO_CLASS.get(legacy_prefix)
+        return cls.prefix if cls is not None else legacy_prefix
+    return data[:1]
+
+
 class Role(Enum):
     ADMIN = "admin"
     USER = "user"
@@ -50,17 +132,55 @@ class Role(Enum):
 class ChooseRoleData(CallbackData):
     role: Role
     user_id: int
-    prefix: str = "choose_role"
+    prefix: str = "r"
+    legacy_prefix: ClassVar[str] = "choose_role"
 
 
 @dataclass
 class BarrierData(CallbackData):
     barrier_id: ObjectId
-    prefix: str = "barrier"
+    prefix: str = "b"
+    legacy_prefix: ClassVar[str] = "barrier"
 
 
 @dataclass
 class BarrierAccessData(CallbackData):
     barrier_id: ObjectId
     user_id: int
-    prefix: str = "barrier_access"
\ No newline at end of file
+    prefix: str = "a"
+    legacy_prefix: ClassVar[str] = "barrier_access"
+
+
+@dataclass
+class HistoryData(CallbackData):
+    barrier_id: ObjectId
+    # page of events before the last event of the previous page,
+    # its timestamp in milliseconds since epoch in UTC and its id
+    before: int
+    before_id: ObjectId
+    prefix: str = "h"
+
+
+@dataclass
+class BarriersPageData(CallbackData):
+    # page of the /open keyboard, set by its prev/next buttons
+    page: int
+    prefix: str = "p"
+
+
+@dataclass
+class BarrierAccessPageData(CallbackData):
+    # page of the access keyboard of user `user_id`
+    user_id: int
+    page: int
+    prefix: str = "q"
+
+
+_LEGACY_PREFIX_TO_CLASS: Dict[str, Type[CallbackData]] = {
+    cls.legacy_prefix: cls
+    for cls in (
+        ChooseRoleData,
+        BarrierData,
+        BarrierAccessData,
+    )
+}
@@ -1,23 +1,41 @@
 from contextlib import contextmanager
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict, Callable, Awaitable, Iterator
 from functools import wraps
 import logging
+import re
 import base64
 import secrets
 
 
 import telegram
-from telegram import Update, Message, Bot
+from telegram import Update, Message, Bot, InlineKeyboardButton
 from telegram.ext import CallbackContext
 from telegram.constants import ChatAction, ParseMode
 
 from bot import config
-from bot.database import db
+from bot import metrics
+from bot.services import services
 from bot.handlers import manage_data as md
 
 
 logger = logging.getLogger(__name__)
 
+# barriers per page of inline keyboards, Telegram allows 100 buttons in total
+BARRIERS_PAGE_SIZE = 10
+
+# where to split long texts, from the most to the least preferred
+TEXT_SEPARATORS = ('\n\n', '\n', '. ', '! ', '? ', ', ', ' ')
+# html tag, or its beginning cut off by the end of the searched range,
+# and an entity cut off the same way. Lengths are bounded, so a stray "<"
+# or "&" in text doesn't keep the splitter from breaking after it. A name
+# character can't follow the name, so the name and the rest of the tag never
+# overlap and a "<" before a long word fails without backtracking
+_TAG_PATTERN = re.compile(r"<(/?)([a-zA-Z][\w-]*)?(?![\w-])[^<>]{0,1000}(?:>|\Z)")
+_ENTITY_END_PATTERN = re.compile(r"&#?\w{0,32}\Z")
+
+# html tags open at some position in text as ((name, opening tag), ...)
+TagStack = Tuple[Tuple[str, str], ...]
+
 
 def get_start_url(source: str) -> str:
     link = f"https://t.me/{config.bot_username}?start=source={source}"
@@ -43,24 +61,30 @@ def add_handler_routines(
     answer_callback_query: bool = False,
 ):
     def decorator(f):
+        handler_latency = metrics.HANDLER_LATENCY.labels(handler=f.__name__)
+
         @wraps(f)
         async def _fn(update: Update, context: CallbackContext, *args, **kwargs):
+            with metrics.UPDATES_IN_FLIGHT.track_inprogress(), handler_latency.time():
+                await _handle(update, context, *args, **kwargs)
+
+        async def _handle(update: Update, context: CallbackContext, *args, **kwargs):
             user = update.effective_user
             user_id = user.id
-            db.add_or_update_user(
+            await services.db.update_user_profile(
                 user_id,
                 username=user.username,
                 first_name=user.first_name,
                 last_name=user.last_name,
             )
-            role = db.get_user_role(user_id)
+            role = await services.db.get_user_role(user_id)
             is_admin = (
                 (role == md.Role.ADMIN) or
                 user.username in config.admin_usernames
             )
             if not is_admin and (
                 check_is_admin or
-                (check_is_allowed_to_open_barriers and not db.is_user_allowed_to_open_barrier(user_id))
+                (check_is_allowed_to_open_barriers and not await services.db.is_user_allowed_to_open_barrier(user_id))
             ):
                 await send_reply(
                     message=update.effective_message,
@@ -85,6 +109,42 @@ def add_handler_routines(
     return decorator
 
 
+def make_callback_query_router(
+    handlers: Dict[str, Callable[[Update, CallbackContext], Awaitable[None]]],
+    default: Callable[[Update, CallbackContext], Awaitable[None]],
+):
+    """Single callback query handler dispatching on `CallbackData` type tag with a dict lookup"""
+    async def route_callback_query(update: Update, context: CallbackContext) -> None:
+        handler = handlers.get(md.get_prefix(update.callback_query.data or ""), default)
+        await handler(update, context)
+    return route_callback_query
+
+
+def get_page_count(n_items: int, page_size: int = BARRIERS_PAGE_SIZE) -> int:
+    return max(1, -(-n_items // page_size))
+
+
+def clamp_page(page: int, n_items: int, page_size: int = BARRIERS_PAGE_SIZE) -> int:
+    """Pages of old keyboards may be out of range after barriers are removed"""
+    return max(0, min(page, get_page_count(n_items, page_size) - 1))
+
+
+def make_page_buttons(
+    page: int,
+    n_items: int,
+    make_data: Callable[[int], md.CallbackData],
+    page_size: int = BARRIERS_PAGE_SIZE,
+) -> List[InlineKeyboardButton]:
+    """Prev/next buttons of a paged keyboard, empty if everything fits one page"""
+    n_pages = get_page_count(n_items, page_size)
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text=f"⬅️ {page}/{n_pages}", callback_data=make_data(page - 1).dump()))
+    if page < n_pages - 1:
+        buttons.append(InlineKeyboardButton(text=f"{page + 2}/{n_pages} ➡️", callback_data=make_data(page + 1).dump()))
+    return buttons
+
+
 def split_text_into_chunks(text, chunk_size):
     for i in range(0, len(text), chunk_size):
         yield text[i : i + chunk_size]
@@ -187,52 +247,149 @@ def wrap_heading_dash(heading: str, n: Optional[int] = None):
 def split_text_at_good_places(
     text: str,
     message_size_limit: int,
-):
-    parts = _split_text(text, message_size_limit=message_size_limit)
-    return _combine_parts(parts, message_size_limit=message_size_limit)
-
-
-def _split_text(
+) -> Iterator[str]:
+    """
+    Yields chunks shorter than `message_size_limit`, each as long as possible
+    while ending after the most preferred of `TEXT_SEPARATORS`: the text is
+    split at '\n\n', parts too long are split at '\n' and so on, then parts
+    are packed greedily. Never breaks inside an html tag or entity, tags open
+    at a break are closed at the end of the chunk and reopened in the next one.
+    Every chunk costs a few searches within its own window, so the whole text is
+    split in linear time
+    """
+    chunk_start, start_tags = 0, ()
+    runs = {}
+    while True:
+        start_tags_size = sum(len(x) for _, x in start_tags)
+        max_end = max(chunk_start + message_size_limit - 1 - start_tags_size, chunk_start + 1)
+        while True:
+            if max_end >= len(text):
+                end = len(text)
+            else:
+                end = _find_break(text, chunk_start, max_end, message_size_limit, runs)
+                if end <= chunk_start:
+                    # not a single separator to break at, cut anywhere
+                    end = max_end
+            end_tags, safe_end = _scan_markup(text, chunk_start, end, start_tags)
+            if safe_end <= chunk_start:
+                # a tag longer than the whole message, can't keep it
+                end_tags = start_tags
+                break
+            end = safe_end
+            overflow = start_tags_size + end - chunk_start + sum(len(x) + 3 for x, _ in end_tags) - (message_size_limit - 1)
+            if overflow <= 0 or end == chunk_start + 1:
+                break
+            max_end = max(end - overflow, chunk_start + 1)
+
+        # closing tags right at the break are free, keep them instead of reopening empty ones
+        while end_tags and text.startswith(f"</{end_tags[-1][0]}>", end):
+            end += len(end_tags[-1][0]) + 3
+            end_tags = end_tags[:-1]
+        yield (
+            "".join(x for _, x in start_tags)
+            + text[chunk_start:end]
+            + "".join(f"</{x}>" for x, _ in reversed(end_tags))
+        )
+        if end >= len(text):
+            return
+        chunk_start, start_tags = end, end_tags
+
+
+def _find_break(
     text: str,
+    start: int,
+    max_end: int,
     message_size_limit: int,
-    separators: Tuple[str] = (
-        '\n\n',
-        '\n',
-        '. ',
-        '! ',
-        '? ',
-        ', ',
-        ' ',
-    ),
-) -> List[str]:
-    if len(separators) == 0:
-        parts = split_text_into_chunks(text, message_size_limit - 1)
-    else:
-        separator = separators[0]
-        parts = text.split(separator)
-        parts = [x + separator for x in parts[:-1]] + [parts[-1]]
-
-    result = []
-    for part in parts:
-        if len(part) < message_size_limit:
-            result.append(part)
-        else:
-            result += _split_text(
-                part,
-                message_size_limit,
-                separators=separators[1:],
-            )
-    return result
-
-
-def _combine_parts(parts: List[str], message_size_limit: int):
-    result = [parts[0]]
-    for part in parts[1:]:
-        if len(result[-1] + part) < message_size_limit:
-            result[-1] = result[-1] + part
-        else:
-            result.append(part)
-    return result
+    runs: Dict[str, Tuple[int, int]],
+) -> int:
+    """
+    Finds the last end of a part not after `max_end`, the parts being those the text
+    is split into by `TEXT_SEPARATORS` recursively. Returns `start` if there is none
+    """
+    # the part containing max_end of the previous separator, `low` may be underestimated if before `start`
+    low, high = 0, len(text)
+    # no need to look for part ends further than the next chunk
+    horizon = max_end + message_size_limit + 2
+    for separator in TEXT_SEPARATORS:
+        n = len(separator)
+        part_start = None
+        separator_start = text.rfind(separator, max(low, start - n + 1), max_end)
+        if separator_start != -1:
+            if n > 1 and separator == separator[0] * n:
+                # str.split takes overlapping separators like '\n\n' in runs of '\n' left to right
+                run_start = _find_run_start(text, separator_start, low, separator[0], runs)
+                separator_start -= (separator_start - run_start) % n
+            if separator_start + n > start:
+                part_start = separator_start + n
+        if part_start is None and low > start:
+            part_start = low
+
+        next_separator_start = text.find(
+            separator,
+            part_start if part_start is not None else max(low, max_end - n + 1),
+            min(high, horizon),
+        )
+        part_end = min(high, horizon) if next_separator_start == -1 else next_separator_start + n
+        if part_start is not None:
+            if part_end - part_start < message_size_limit:
+                return part_start
+            low = part_start
+        high = part_end
+
+    # what's left is cut into equal pieces, starting from the last part start
+    if low <= start:
+        return max_end
+    return low + (max_end - low) // (message_size_limit - 1) * (message_size_limit - 1)
+
+
+def _find_run_start(text: str, position: int, low: int, char: str, runs: Dict[str, Tuple[int, int]]) -> int:
+    """
+    Finds where the run of `char` containing `position` starts, not before `low`.
+    `runs` remembers the last run found and how far it is known to go, so a long
+    run split into many chunks is scanned once
+    """
+    run_start, run_end = runs.get(char, (-1, -1))
+    if run_start <= position <= run_end or (0 <= run_start <= run_end < position and not text[run_end:position].strip(char)):
+        runs[char] = (run_start, max(run_end, position))
+        return max(run_start, low)
+
+    step = 64
+    while True:
+        left = max(low, position - step)
+        stripped = len(text[left:position].rstrip(char))
+        if stripped > 0 or left == low:
+            runs[char] = (left + stripped, position)
+            return left + stripped
+        step *= 2
+
+
+def _scan_markup(text: str, start: int, end: int, tags: TagStack) -> Tuple[TagStack, int]:
+    """
+    Applies html tags from text[start:end] to the stack of open `tags`.
+    Returns the new stack and `end`, moved back if it cuts a tag or an entity
+    """
+    position = start
+    while True:
+        match = _TAG_PATTERN.search(text, position, end)
+        if match is None:
+            break
+        if not match.group(0).endswith(">"):
+            # the beginning of a tag cut off at `end`
+            return tags, match.start()
+        closing, name = match.group(1), match.group(2)
+        if name is not None and not closing:
+            tags = tags + ((name.lower(), match.group(0)),)
+        elif name is not None:
+            for i in range(len(tags) - 1, -1, -1):
+                if tags[i][0] == name.lower():
+                    tags = tags[:i]
+                    break
+        position = match.end()
+
+    match = _ENTITY_END_PATTERN.search(text, max(position, end - 40), end)
+    if match is not None:
+        return tags, match.start()
+    return tags, end
 
 
 @contextmanager
@@ -0,0 +1,72 @@
+from functools import wraps
+import inspect
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_latency_seconds",
+    "Time spent in update handlers",
+    ["handler"],
+)
+UPDATES_IN_FLIGHT = Gauge(
+    "bot_updates_in_flight",
+    "Updates being handled right now",
+)
+MONGO_LATENCY = Histogram(
+    "bot_mongo_operation_latency_seconds",
+    "Time spent in Database methods",
+    ["method"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float("inf")),
+)
+MONGO_ERRORS = Counter(
+    "bot_mongo_operation_errors_total",
+    "Database methods raising an exception",
+    ["method"],
+)
+ZADARMA_LATENCY = Histogram(
+    "bot_zadarma_call_latency_seconds",
+    "Time spent in single Zadarma API requests",
+    ["method", "outcome"],
+)
+ZADARMA_CALL_OUTCOMES = Counter(
+    "bot_zadarma_call_outcomes_total",
+    "Ended outgoing calls reported by Zadarma notifications",
+    ["disposition"],
+)
+ZADARMA_RATE_LIMITER_WAITING = Gauge(
+    "bot_zadarma_rate_limiter_waiting",
+    "Zadarma calls waiting for a rate limiter token",
+)
+
+
+def instrument_database(cls):
+    """Class decorator recording latency and errors of every public coroutine method"""
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(method):
+            continue
+        setattr(cls, name, _timed_mongo_method(method))
+    return cls
+
+
+def _timed_mongo_method(method):
+    latency = MONGO_LATENCY.labels(method=method.__name__)
+    errors = MONGO_ERRORS.labels(method=method.__name__)
+
+    @wraps(method)
+    async def _fn(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started_at)
+    return _fn
+
+
+def start_metrics_server(port: int, addr: str = "127.0.0.1") -> None:
+    """Serves all metrics on http://addr:port/metrics from a background thread"""
+    start_http_server(port, addr=addr)
@@ -0,0 +1,96 @@
+from functools import cached_property
+
+from bot import config
+from bot import metrics
+from bot.cache import LRUCache
+from bot.database import Database
+from bot.dispatch import OpenDispatcher, MongoOpenLease
+from bot.watcher import CacheWatcher
+from bot.zadarma.api import AsyncZadarmaAPI
+from bot.zadarma.governor import ZadarmaGovernor
+
+
+class Services:
+    """
+    Application context holding the long-living clients and caches.
+    Every service is built on first access, so importing the handlers
+    neither reads config nor opens connections. `run_bot` loads config
+    and warms services up in `post_init`, `close` releases them on shutdown
+    """
+
+    @cached_property
+    def db(self) -> Database:
+        return Database()
+
+    @cached_property
+    def keyboard_cache(self) -> LRUCache:
+        # prebuilt inline keyboards, keys must include everything a keyboard depends on
+        return LRUCache(maxsize=config.keyboard_cache_size, ttl=config.barrier_cache_ttl)
+
+    @cached_property
+    def z_api(self) -> AsyncZadarmaAPI:
+        return AsyncZadarmaAPI(
+            key=config.zadarma_api_key,
+            secret=config.zadarma_api_secret,
+            connect_timeout=config.zadarma_connect_timeout,
+            read_timeout=config.zadarma_read_timeout,
+        )
+
+    @cached_property
+    def z_governor(self) -> ZadarmaGovernor:
+        governor = ZadarmaGovernor(
+            self.z_api,
+            # every worker gets its share of the account-wide limit
+            rate_limit_per_minute=config.zadarma_rate_limit_per_minute / config.workers,
+            max_attempts=config.zadarma_max_attempts,
+            failure_threshold=config.zadarma_circuit_failure_threshold,
+            recovery_timeout=config.zadarma_circuit_recovery_timeout,
+        )
+        metrics.ZADARMA_RATE_LIMITER_WAITING.set_function(lambda: governor.bucket.waiting)
+        return governor
+
+    @cached_property
+    def open_dispatcher(self) -> OpenDispatcher:
+        from bot.gates import call_number  # gates use services in turn
+        return OpenDispatcher(
+            call_number,
+            window=config.barrier_open_coalesce_window,
+            lease=MongoOpenLease(
+                self.db,
+                ttl=self.z_governor.get_max_call_duration(config.zadarma_connect_timeout + config.zadarma_read_timeout),
+                window=config.barrier_open_coalesce_window,
+                wait_timeout=config.barrier_open_wait_timeout,
+            ) if config.workers > 1 else None,
+        )
+
+    @cached_property
+    def notification_receiver(self) -> "NotificationReceiver":
+        from bot.zadarma.notifications import NotificationReceiver  # tornado is imported only if notifications are on
+        return NotificationReceiver(
+            self.z_api,
+            listen=config.zadarma_notifications_listen,
+            port=config.zadarma_notifications_port,
+            path=config.zadarma_notifications_path,
+            utc_offset_hours=config.zadarma_utc_offset_hours,
+        )
+
+    @cached_property
+    def cache_watcher(self) -> CacheWatcher:
+        # version polling only sees writes of other workers, useless for a single one
+        return CacheWatcher(self.db, poll_interval=config.cache_sync_interval, poll=config.workers > 1)
+
+    def is_built(self, name: str) -> bool:
+        return name in vars(self)
+
+    async def close(self) -> None:
+        if self.is_built("cache_watcher"):
+            await self.cache_watcher.stop()
+        if self.is_built("notification_receiver"):
+            await self.notification_receiver.stop()
+        if self.is_built("z_api"):
+            await self.z_api.close()
+        if self.is_built("db"):
+            self.db.client.close()
+
+
+services = Services()
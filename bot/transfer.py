@@ -0,0 +1,178 @@
+"""
+Export and import of `user` and `barrier` collections as JSON Lines or CSV,
+shared by the /export and /import commands and `transfer.py`. Both directions
+stream: export reads a cursor in batches, import upserts in chunks, so memory
+doesn't depend on the size of a collection
+"""
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+from dataclasses import dataclass, field
+import csv
+import io
+import json
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+from bot.database import Database
+from bot.handlers import manage_data as md
+from bot.validation import is_valid_phone_number
+
+
+EXPORT_BATCH_SIZE = 500
+IMPORT_CHUNK_SIZE = 500
+# errors kept for the report, the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+COLLECTIONS = ("user", "barrier")
+FORMATS = ("jsonl", "csv")
+# CSV columns, also the only fields exported and imported
+FIELDS = {
+    "user": ("_id", "role", "username", "first_name", "last_name", "barriers"),
+    "barrier": ("_id", "phone_number", "name"),
+}
+# separator of barrier ids in the `barriers` CSV column
+CSV_LIST_SEPARATOR = ";"
+
+
+@dataclass
+class ImportResult:
+    n_rows: int = 0
+    n_matched: int = 0
+    n_inserted: int = 0
+    n_errors: int = 0
+    errors: List[str] = field(default_factory=list)
+
+    def add_error(self, line_number: int, message: str) -> None:
+        self.n_errors += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"строка {line_number}: {message}")
+
+
+def get_format(filename: str) -> str:
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+
+def _to_plain(collection_name: str, document: Dict[str, Any]) -> Dict[str, Any]:
+    row = {key: document[key] for key in FIELDS[collection_name] if document.get(key) is not None}
+    if isinstance(row.get("_id"), ObjectId):
+        row["_id"] = str(row["_id"])
+    if "barriers" in row:
+        row["barriers"] = [str(x) for x in row["barriers"]]
+    return row
+
+
+async def iter_export(db: Database, collection_name: str, format: str) -> AsyncIterator[str]:
+    """Yields lines of the exported collection, the header first for CSV"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDS[collection_name], lineterminator="\n")
+    if format == "csv":
+        writer.writeheader()
+    async for document in db.find_all(collection_name, batch_size=EXPORT_BATCH_SIZE):
+        row = _to_plain(collection_name, document)
+        if format == "jsonl":
+            buffer.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            if "barriers" in row:
+                row["barriers"] = CSV_LIST_SEPARATOR.join(row["barriers"])
+            writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _parse_object_id(value: Any) -> ObjectId:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise ValueError(f"неверный id {value!r}")
+
+
+def _parse_row(collection_name: str, row: Dict[str, Any]) -> Dict[str, Any]:
+    """Validates a row of any format and converts it to a document, raises ValueError"""
+    # empty CSV cells and nulls leave the stored value as is
+    row = {key: value for key, value in row.items() if key in FIELDS[collection_name] and value not in (None, "")}
+    if collection_name == "user":
+        if "_id" not in row:
+            raise ValueError("пользователь без _id")
+        try:
+            row["_id"] = int(row["_id"])
+        except (TypeError, ValueError):
+            raise ValueError(f"неверный id пользователя {row['_id']!r}")
+        if "role" in row and row["role"] not in {x.value for x in md.Role}:
+            raise ValueError(f"неверная роль {row['role']!r}")
+        if "barriers" in row:
+            barriers = row["barriers"]
+            if isinstance(barriers, str):
+                barriers = [x for x in barriers.split(CSV_LIST_SEPARATOR) if x]
+            if not isinstance(barriers, list):
+                raise ValueError(f"неверный список шлагбаумов {barriers!r}")
+            row["barriers"] = [_parse_object_id(x) for x in barriers]
+        for key in ("username", "first_name", "last_name"):
+            if key in row:
+                row[key] = str(row[key])
+    else:
+        row["_id"] = _parse_object_id(row["_id"]) if "_id" in row else ObjectId()
+        phone_number = str(row.get("phone_number", ""))
+        if not is_valid_phone_number(phone_number):
+            raise ValueError(f"неверный формат номера {phone_number!r}, нужен +7XXXXXXXXXX")
+        name = "_".join(str(row.get("name", "")).split())
+        if not name:
+            raise ValueError("не вижу названия шлагбаума")
+        row["phone_number"], row["name"] = phone_number, name
+    return row
+
+
+def _iter_rows(lines: Iterable[str], format: str):
+    """Yields (line number, row or None if the line is not parsable)"""
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+async def import_lines(db: Database, collection_name: str, format: str, lines: Iterable[str]) -> ImportResult:
+    """Upserts valid rows by `_id` in chunks of `IMPORT_CHUNK_SIZE`, skipping and reporting invalid ones"""
+    result = ImportResult()
+    chunk = []
+
+    async def flush():
+        n_matched, n_inserted = await db.upsert_documents(collection_name, chunk)
+        result.n_matched += n_matched
+        result.n_inserted += n_inserted
+        chunk.clear()
+
+    for line_number, row in _iter_rows(lines, format):
+        result.n_rows += 1
+        if row is None:
+            result.add_error(line_number, "не JSON-объект")
+            continue
+        try:
+            chunk.append(_parse_row(collection_name, row))
+        except ValueError as e:
+            result.add_error(line_number, str(e))
+            continue
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await flush()
+    if chunk:
+        await flush()
+    return result
+
+
+def format_import_result(collection_name: str, result: ImportResult) -> str:
+    lines = [
+        f"{collection_name}: строк {result.n_rows}, обновлено {result.n_matched}, "
+        f"добавлено {result.n_inserted}, пропущено {result.n_errors}"
+    ]
+    lines.extend(result.errors)
+    if result.n_errors > len(result.errors):
+        lines.append(f"... и ещё ошибок: {result.n_errors - len(result.errors)}")
+    return "\n".join(lines)
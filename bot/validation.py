@@ -0,0 +1,12 @@
+def is_valid_phone_number(phone_number: str) -> bool:
+    """Barrier phone numbers are stored as +7XXXXXXXXXX"""
+    return (
+        phone_number.startswith("+7") and
+        all(x.isdigit() for x in phone_number[1:]) and
+        len(phone_number) == 12
+    )
+
+
+def normalize_phone_number(phone_number: str) -> str:
+    """Zadarma reports numbers without "+", e.g. 7XXXXXXXXXX"""
+    return "+" + "".join(x for x in phone_number if x.isdigit())
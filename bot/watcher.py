@@ -0,0 +1,111 @@
+from typing import Any, Dict, Optional
+import asyncio
+import logging
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from bot.database import Database
+
+
+logger = logging.getLogger(__name__)
+
+# "$changeStream is only supported on replica sets", e.g. the standalone mongo of docker-compose.yml
+CHANGE_STREAMS_UNSUPPORTED_CODES = {40573}
+# resume token is too old for the oplog, changes in between are lost
+CHANGE_STREAM_HISTORY_LOST_CODES = {136, 286, 280}
+WATCHED_COLLECTIONS = ("user", "barrier")
+
+
+class CacheWatcher:
+    """
+    Keeps in-process user and barrier caches in sync with writes made by
+    other workers, mongo-express or anything else writing to mongo. Follows
+    a change stream of the `user` and `barrier` collections: changed users
+    that are cached are patched, changed barriers are dropped. Without
+    change streams falls back to `Database.sync_caches` polling
+    """
+
+    def __init__(self, db: Database, poll_interval: float, poll: bool = True, retry_interval: float = 5.0):
+        """
+        :param poll: whether to poll if change streams are unavailable,
+            polling only sees writes of other bot workers
+        """
+        self.db = db
+        self.poll_interval = poll_interval
+        self.poll = poll
+        self.retry_interval = retry_interval
+        self.resume_token: Optional[Dict[str, Any]] = None
+        self.is_watching = False
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self) -> None:
+        try:
+            await self.watch()
+        except OperationFailure as e:
+            if e.code not in CHANGE_STREAMS_UNSUPPORTED_CODES:
+                raise
+            logger.warning(f"Change streams are unavailable ({e}), falling back to polling")
+        if self.poll:
+            await self.poll_versions()
+
+    async def watch(self) -> None:
+        """Follows the change stream forever, resuming after errors"""
+        pipeline = [{"$match": {"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+        while True:
+            try:
+                async with self.db.db.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    resume_after=self.resume_token,
+                ) as stream:
+                    if not self.is_watching:
+                        logger.info("Watching user and barrier changes")
+                        self.is_watching = True
+                    async for change in stream:
+                        self.apply(change)
+                        # a stream can't be resumed after "invalidate", a new one is started
+                        self.resume_token = stream.resume_token if change["operationType"] != "invalidate" else None
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAMS_UNSUPPORTED_CODES:
+                    raise
+                if e.code in CHANGE_STREAM_HISTORY_LOST_CODES:
+                    self.resume_token = None
+                logger.exception("Change stream failed, restarting")
+            except PyMongoError:
+                logger.exception("Change stream failed, restarting")
+            # changes might have been missed meanwhile
+            self.db.drop_caches()
+            await asyncio.sleep(self.retry_interval)
+
+    def apply(self, change: Dict[str, Any]) -> None:
+        if change["operationType"] in ("drop", "rename", "dropDatabase", "invalidate"):
+            self.db.drop_caches()
+            return
+        _id = change["documentKey"]["_id"]
+        collection = change["ns"]["coll"]
+        if collection == "user":
+            # deleted users and updates the lookup found deleted since come without document
+            self.db.refresh_cached_user(_id, change.get("fullDocument"))
+        elif collection == "barrier":
+            self.db.refresh_cached_barrier(_id)
+
+    async def poll_versions(self) -> None:
+        while True:
+            try:
+                await self.db.sync_caches()
+            except Exception:
+                logger.exception("Could not sync caches with other workers")
+            await asyncio.sleep(self.poll_interval)
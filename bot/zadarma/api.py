@@ -4,9 +4,12 @@ from collections import OrderedDict
 
 from urllib.parse import urlencode
 import hmac
-import requests
+import time
+import httpx
 import base64
 
+from bot import metrics
+
 
 class ZadarmaAPI(object):
     def __init__(self, key, secret, is_sandbox=False):
@@ -23,6 +26,10 @@ class ZadarmaAPI(object):
         if is_sandbox:
             self.__url_api = "https://api-sandbox.zadarma.com"
 
+    @property
+    def url_api(self):
+        return self.__url_api
+
     def call(self, method, params={}, request_type="GET", format="json", is_auth=True):
         """
         Function for send API request
@@ -33,24 +40,10 @@ class ZadarmaAPI(object):
         :param is_auth: (True|False)
         :return: response
         """
-        request_type = request_type.upper()
-        if request_type not in ["GET", "POST", "PUT", "DELETE"]:
-            request_type = "GET"
-        params["format"] = format
-        auth_str = None
-        is_nested_data = False
-        for k in params.values():
-            if not isinstance(k, str):
-                is_nested_data = True
-                break
-        if is_nested_data:
-            params_string = self.__http_build_query(OrderedDict(sorted(params.items())))
-            params = params_string
-        else:
-            params_string = urlencode(OrderedDict(sorted(params.items())))
-
-        if is_auth:
-            auth_str = self.__get_auth_string_for_header(method, params_string)
+        request_type, params, params_string, auth_str = self._prepare_request(
+            method, params, request_type, format, is_auth,
+        )
+        import requests  # only the blocking client needs it, keeps importing the bot cheap
 
         if request_type == "GET":
             result = requests.get(
@@ -77,6 +70,32 @@ class ZadarmaAPI(object):
             )
         return result.text
 
+    def _prepare_request(self, method, params, request_type, format, is_auth):
+        """
+        Normalizes request type, encodes params and signs them
+        :return: (request_type, params, params_string, auth_str)
+        """
+        request_type = request_type.upper()
+        if request_type not in ["GET", "POST", "PUT", "DELETE"]:
+            request_type = "GET"
+        params = {**params, "format": format}
+        auth_str = None
+        is_nested_data = False
+        for k in params.values():
+            if not isinstance(k, str):
+                is_nested_data = True
+                break
+        if is_nested_data:
+            params_string = self.__http_build_query(OrderedDict(sorted(params.items())))
+            params = params_string
+        else:
+            params_string = urlencode(OrderedDict(sorted(params.items())))
+
+        if is_auth:
+            auth_str = self.__get_auth_string_for_header(method, params_string)
+
+        return request_type, params, params_string, auth_str
+
     def __http_build_query(self, data):
         parents = list()
         pairs = dict()
@@ -114,10 +133,101 @@ class ZadarmaAPI(object):
         :return: auth header
         """
         data = method + params_string + md5(params_string.encode("utf8")).hexdigest()
+        auth = self.key + ":" + self._sign(data)
+        return auth
+
+    def _sign(self, data):
+        """
+        :param data: string to sign
+        :return: base64 of hex HMAC-SHA1 with the secret, as used by requests and notifications
+        """
         hmac_h = hmac.new(self.secret.encode("utf8"), data.encode("utf8"), sha1)
         if sys.version_info.major > 2:
             bts = bytes(hmac_h.hexdigest(), "utf8")
         else:
             bts = bytes(hmac_h.hexdigest()).encode("utf8")
-        auth = self.key + ":" + base64.b64encode(bts).decode()
-        return auth
+        return base64.b64encode(bts).decode()
+
+    def verify_notification(self, data, signature):
+        """
+        :param data: concatenated notification fields, depends on the event
+        :param signature: value of the Signature header
+        :return: (True|False)
+        """
+        return hmac.compare_digest(self._sign(data), signature or "")
+
+
+class AsyncZadarmaAPI(ZadarmaAPI):
+    def __init__(
+        self,
+        key,
+        secret,
+        is_sandbox=False,
+        connect_timeout=3.0,
+        read_timeout=10.0,
+        max_connections=10,
+        url_api=None,
+    ):
+        """
+        Constructor of asyncio client keeping a keep-alive connection pool to the API
+        :param key: key from personal
+        :param secret: secret from personal
+        :param is_sandbox: (True|False)
+        :param connect_timeout: seconds to establish connection
+        :param read_timeout: seconds to wait for response
+        :param max_connections: size of connection pool
+        :param url_api: overrides API url (e.g. for local fake server)
+        """
+        super().__init__(key=key, secret=secret, is_sandbox=is_sandbox)
+        self._url_api = url_api or super().url_api
+        self.client = httpx.AsyncClient(
+            base_url=self._url_api,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    @property
+    def url_api(self):
+        return self._url_api
+
+    async def call(self, method, params={}, request_type="GET", format="json", is_auth=True):
+        """
+        Function for send API request
+        :param method: API method, including version number
+        :param params: Query params
+        :param request_type: (get|post|put|delete)
+        :param format: (json|xml)
+        :param is_auth: (True|False)
+        :return: response
+        :raises httpx.HTTPError: on connection errors, timeouts and non-2xx statuses
+        """
+        request_type, params, params_string, auth_str = self._prepare_request(
+            method, params, request_type, format, is_auth,
+        )
+        headers = {"Authorization": auth_str} if auth_str is not None else {}
+
+        started_at = time.perf_counter()
+        outcome = "transport_error"
+        try:
+            if request_type == "GET":
+                result = await self.client.get(method + "?" + params_string, headers=headers)
+            else:
+                result = await self.client.request(
+                    request_type,
+                    method,
+                    headers={**headers, "Content-Type": "application/x-www-form-urlencoded"},
+                    content=params_string,
+                )
+            outcome = "success" if result.is_success else f"http_{result.status_code}"
+        finally:
+            metrics.ZADARMA_LATENCY.labels(method=method, outcome=outcome).observe(
+                time.perf_counter() - started_at
+            )
+        result.raise_for_status()
+        return result.text
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,172 @@
+from typing import Optional
+import asyncio
+import logging
+import time
+
+import httpx
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from bot.errors import ZadarmaUnavailableError
+
+
+logger = logging.getLogger(__name__)
+
+
+# the request never reached Zadarma or was explicitly refused, safe to send again
+RETRYABLE_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+RETRYABLE_STATUS_CODES = {429, 503}
+# seconds, longest wait between attempts
+MAX_RETRY_WAIT = 5.0
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """
+    Whether a call can be repeated without the risk of doing it twice.
+    Calls are paid and not idempotent, so e.g. a read timeout is not
+    retried: the callback might have been placed already
+    """
+    if isinstance(error, RETRYABLE_TRANSPORT_ERRORS):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Whether an error means that Zadarma is unavailable, counts towards the circuit breaker"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        self.waiting += 1
+        try:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    for `recovery_timeout` seconds, then lets a single trial call through
+    """
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self) -> None:
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.recovery_timeout or self.trial_in_progress:
+            raise ZadarmaUnavailableError("Zadarma API is unavailable, circuit is open")
+        self.trial_in_progress = True
+
+    def on_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Zadarma API recovered, closing circuit")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def on_failure(self) -> None:
+        self.failures += 1
+        if self.trial_in_progress or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error(f"Opening circuit after {self.failures} failed Zadarma calls")
+            self.opened_at = time.monotonic()
+        self.trial_in_progress = False
+
+
+class ZadarmaGovernor:
+    """
+    Wraps `AsyncZadarmaAPI.call` with rate limiting, retries of requests
+    that didn't reach Zadarma and a circuit breaker
+    """
+
+    def __init__(
+        self,
+        api,
+        rate_limit_per_minute: float = 100,
+        max_attempts: int = 3,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+    ):
+        self.api = api
+        self.bucket = TokenBucket(
+            rate=rate_limit_per_minute / 60,
+            capacity=max(1.0, rate_limit_per_minute / 10),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=failure_threshold,
+            recovery_timeout=recovery_timeout,
+        )
+        self.max_attempts = max_attempts
+
+    def get_max_call_duration(self, timeout: float) -> float:
+        """Seconds a call might take if every attempt takes `timeout` seconds, not counting rate limiting"""
+        return self.max_attempts * timeout + (self.max_attempts - 1) * MAX_RETRY_WAIT
+
+    async def call(self, *args, **kwargs) -> str:
+        """
+        Same as `AsyncZadarmaAPI.call`
+        :raises ZadarmaUnavailableError: if API keeps failing or circuit is open
+        """
+        self.breaker.before_call()
+        try:
+            async for attempt in AsyncRetrying(
+                stop=stop_after_attempt(self.max_attempts),
+                wait=wait_random_exponential(multiplier=0.5, max=MAX_RETRY_WAIT),
+                retry=retry_if_exception(is_retryable_error),
+                reraise=True,
+            ):
+                with attempt:
+                    await self.bucket.acquire()
+                    result = await self.api.call(*args, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker.trial_in_progress = False
+            raise
+        except Exception as e:
+            if not is_transient_error(e):
+                self.breaker.on_success()
+                raise
+            self.breaker.on_failure()
+            raise ZadarmaUnavailableError(f"Zadarma API is unavailable: {e!r}") from e
+        self.breaker.on_success()
+        return result
@@ -0,0 +1,111 @@
+from typing import Awaitable, Callable, Dict, Optional, Set
+from datetime import datetime, timedelta
+import asyncio
+import logging
+
+import tornado.httpserver
+import tornado.web
+
+from bot import metrics
+from bot.zadarma.api import ZadarmaAPI
+
+
+logger = logging.getLogger(__name__)
+
+# fields signed by Zadarma for every notification event, in signing order
+SIGNED_FIELDS = {
+    "NOTIFY_START": ("caller_id", "called_did", "call_start"),
+    "NOTIFY_END": ("caller_id", "called_did", "call_start"),
+    "NOTIFY_OUT_START": ("internal", "destination", "call_start"),
+    "NOTIFY_OUT_END": ("internal", "destination", "call_start"),
+}
+
+CALL_START_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+CallEndCallback = Callable[[str, str, Optional[datetime]], Awaitable[None]]
+
+
+class NotificationReceiver:
+    """
+    HTTP endpoint for Zadarma PBX notifications (personal account -> Settings ->
+    Integrations and API -> Notifications). Checks the signature of every
+    notification and calls `on_call_end(destination, disposition, call_start)`
+    when an outgoing call, like the one placed by `call_number`, ends
+    """
+
+    def __init__(self, api: ZadarmaAPI, listen: str, port: int, path: str, utc_offset_hours: float = 0):
+        """
+        :param utc_offset_hours: time zone of the Zadarma account, `call_start` of
+            notifications is in it and is converted to UTC
+        """
+        self.api = api
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.utc_offset_hours = utc_offset_hours
+        self.on_call_end: Optional[CallEndCallback] = None
+        self.server: Optional[tornado.httpserver.HTTPServer] = None
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def start(self, on_call_end: CallEndCallback) -> None:
+        self.on_call_end = on_call_end
+        application = tornado.web.Application([(self.path, _NotificationHandler, {"receiver": self})])
+        self.server = application.listen(self.port, address=self.listen, xheaders=True)
+        logger.info(f"Receiving Zadarma notifications on {self.listen}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.stop()
+            await self.server.close_all_connections()
+            self.server = None
+
+    def verify(self, fields: Dict[str, str], signature: str) -> bool:
+        signed_fields = SIGNED_FIELDS.get(fields.get("event", ""))
+        if signed_fields is None:
+            return False
+        return self.api.verify_notification("".join(fields.get(x, "") for x in signed_fields), signature)
+
+    def handle_later(self, fields: Dict[str, str]) -> None:
+        task = asyncio.ensure_future(self.handle(fields))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, task: "asyncio.Task[None]") -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Could not handle Zadarma notification", exc_info=task.exception())
+
+    def parse_call_start(self, value: str) -> Optional[datetime]:
+        try:
+            return datetime.strptime(value, CALL_START_FORMAT) - timedelta(hours=self.utc_offset_hours)
+        except ValueError:
+            logger.warning(f"Unexpected call_start {value!r} in Zadarma notification")
+            return None
+
+    async def handle(self, fields: Dict[str, str]) -> None:
+        if fields["event"] != "NOTIFY_OUT_END" or self.on_call_end is None:
+            return
+        disposition = fields.get("disposition", "")
+        metrics.ZADARMA_CALL_OUTCOMES.labels(disposition=disposition).inc()
+        await self.on_call_end(
+            fields.get("destination", ""),
+            disposition,
+            self.parse_call_start(fields.get("call_start", "")),
+        )
+
+
+class _NotificationHandler(tornado.web.RequestHandler):
+    def initialize(self, receiver: NotificationReceiver) -> None:
+        self.receiver = receiver
+
+    def get(self) -> None:
+        # Zadarma checks the url with ?zd_echo=<random string> before sending notifications
+        self.write(self.get_query_argument("zd_echo", ""))
+
+    def post(self) -> None:
+        fields = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+        if not self.receiver.verify(fields, self.request.headers.get("Signature", "")):
+            logger.warning(f"Rejected Zadarma notification with invalid signature from {self.request.remote_ip}")
+            raise tornado.web.HTTPError(401)
+        # answered right away, Zadarma doesn't wait for messages to be edited
+        self.receiver.handle_later(fields)
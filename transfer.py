@@ -0,0 +1,61 @@
+"""
+Export and import of users and barriers, the same as /export and /import in the bot
+
+    python3 transfer.py export user users.jsonl
+    python3 transfer.py export barrier - --format csv > barriers.csv
+    python3 transfer.py import barrier barriers.csv
+
+The format is taken from the file extension unless --format is given
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+from bot import config
+from bot import transfer
+from bot.services import services
+
+
+async def export(args: argparse.Namespace) -> None:
+    f = sys.stdout if args.path == "-" else open(args.path, "w", encoding="utf-8", newline="")
+    try:
+        async for lines in transfer.iter_export(services.db, args.collection, args.format):
+            f.write(lines)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+async def import_(args: argparse.Namespace) -> None:
+    f = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8-sig", newline="")
+    try:
+        result = await transfer.import_lines(services.db, args.collection, args.format, f)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    print(transfer.format_import_result(args.collection, result), file=sys.stderr)
+
+
+async def main(args: argparse.Namespace) -> None:
+    try:
+        await (export(args) if args.command == "export" else import_(args))
+    finally:
+        await services.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)-12s :%(name)-15s: %(levelname)-8s %(message)s'
+    )
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("collection", choices=transfer.COLLECTIONS)
+    parser.add_argument("path", help="file to write or read, - for stdout or stdin")
+    parser.add_argument("--format", choices=transfer.FORMATS)
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = transfer.get_format(args.path)
+    config.load()
+    asyncio.run(main(args))